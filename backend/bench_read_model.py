@@ -0,0 +1,81 @@
+"""
+Compares the drinks list serialization through the ORM (Drink instances)
+and through the read model (DrinkRow tuples selected with SQLAlchemy Core).
+
+usage: python bench_read_model.py [number of drinks] [repeats]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from src.api import create_app
+from src.database.models import setup_db, db, Drink, drink_rows, \
+    drinks_list_short, drinks_list_complete
+
+
+def fill_database(count):
+    db.drop_all()
+    db.create_all()
+    recipe = json.dumps([
+        {'name': 'Milk', 'color': 'lightgray', 'parts': 2},
+        {'name': 'Coffee', 'color': 'black', 'parts': 1}
+    ])
+    db.session.bulk_insert_mappings(Drink, [
+        {'title': f'Drink {i}', 'recipe': recipe} for i in range(count)
+    ])
+    db.session.commit()
+
+
+def orm_list(serialize):
+    return serialize(Drink.query.all())
+
+
+def read_model_list(serialize):
+    return serialize(drink_rows())
+
+
+def measure(fetch, serialize, count, repeats):
+    """Return the best time and the peak allocation per row"""
+    best = float('inf')
+    for _ in range(repeats):
+        db.session.remove()
+        started = time.perf_counter()
+        fetch(serialize)
+        best = min(best, time.perf_counter() - started)
+    db.session.remove()
+    tracemalloc.start()
+    fetch(serialize)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best / count * 1e6, peak / count
+
+
+def main(count=10000, repeats=5):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app()
+        setup_db(app, 'sqlite:///{}'.format(
+            os.path.join(directory, 'bench.db')))
+        with app.app_context():
+            fill_database(count)
+            for name, serialize in (('short', drinks_list_short),
+                                    ('long', drinks_list_complete)):
+                assert orm_list(serialize) == read_model_list(serialize)
+                print(f'{name} form, {count} drinks')
+                results = []
+                for label, fetch in (('orm', orm_list),
+                                     ('read model', read_model_list)):
+                    cpu, memory = measure(fetch, serialize, count, repeats)
+                    results.append((cpu, memory))
+                    print(f'  {label:<10} {cpu:8.2f} us/row '
+                          f'{memory:8.0f} B/row peak')
+                (orm_cpu, orm_memory), (cpu, memory) = results
+                print(f'  {"speedup":<10} {orm_cpu / cpu:8.2f}x        '
+                      f'{orm_memory / memory:8.2f}x less memory')
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
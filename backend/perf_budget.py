@@ -0,0 +1,187 @@
+"""
+Performance budgets for the API tests.
+
+A budget caps what one request may cost: the SQL statements it runs, the
+HTTP calls made to Auth0 while checking its token, its peak of allocated
+memory and its latency. The requests run offline, the tokens are signed by
+a key generated for the tests and the Auth0 public keys are served locally.
+
+Tracing the allocations slows the code down several times, so a measure
+gives either the allocated memory or the latency (trace_memory=False), a
+request is measured twice to get both.
+
+EXAMPLE
+    auth = OfflineAuth()
+    with auth.installed():
+        with measure() as cost:
+            client.get('/drinks-detail', headers=auth.headers(['...']))
+    cost.check(Budget(max_queries=1, max_http_calls=0), 'GET /drinks-detail')
+"""
+import base64
+import json
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from unittest import mock
+from Crypto.PublicKey import RSA
+from jose import jwt
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src.auth import auth
+
+
+class Budget(namedtuple('Budget', ['max_queries', 'max_http_calls',
+                                   'max_alloc_kb', 'max_ms'])):
+    """
+    Budget
+    the maximum cost of one request, None leaves a resource unchecked
+    """
+    __slots__ = ()
+
+    def __new__(cls, max_queries=None, max_http_calls=None,
+                max_alloc_kb=None, max_ms=None):
+        return super().__new__(cls, max_queries, max_http_calls,
+                               max_alloc_kb, max_ms)
+
+
+class BudgetExceeded(AssertionError):
+    pass
+
+
+def _rounded(value, digits=None):
+    return None if value is None else round(value, digits)
+
+
+class Cost:
+    """What a measured block of code cost, None for an unmeasured resource"""
+    def __init__(self):
+        self.statements = []
+        self.http_calls = []
+        self.alloc_kb = None
+        self.ms = None
+
+    @property
+    def queries(self):
+        return len(self.statements)
+
+    def check(self, budget, name):
+        """
+        Raise a BudgetExceeded error listing every resource over budget,
+        with the SQL statements and HTTP calls made
+        """
+        rows = [
+            ('sql statements', self.queries, budget.max_queries),
+            ('http calls', len(self.http_calls), budget.max_http_calls),
+            ('allocated kB', _rounded(self.alloc_kb), budget.max_alloc_kb),
+            ('latency ms', _rounded(self.ms, 1), budget.max_ms)
+        ]
+        exceeded = [(label, spent, limit) for label, spent, limit in rows
+                    if None not in (spent, limit) and spent > limit]
+        if not exceeded:
+            return
+        lines = [f'{name} is over budget:']
+        lines += [f'  {label:<15} {spent:>8} > {limit}'
+                  for label, spent, limit in exceeded]
+        if budget.max_queries is not None:
+            lines.append('sql statements:')
+            lines += [f'  {i}. {" ".join(statement.split())}'
+                      for i, statement in enumerate(self.statements, 1)]
+        if budget.max_http_calls is not None and self.http_calls:
+            lines.append('http calls:')
+            lines += [f'  {i}. {url}'
+                      for i, url in enumerate(self.http_calls, 1)]
+        raise BudgetExceeded('\n'.join(lines))
+
+
+# The Cost of the running measure() block, the HTTP calls are added to it
+_current = []
+
+
+@contextmanager
+def measure(trace_memory=True):
+    """
+    Measure the cost of the block, see Cost
+    the latency is only measured without trace_memory, the tracing overhead
+    would be part of it
+    """
+    cost = Cost()
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        cost.statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    _current.append(cost)
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        yield cost
+    finally:
+        if trace_memory:
+            cost.alloc_kb = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+        else:
+            cost.ms = (time.perf_counter() - started) * 1000
+        _current.remove(cost)
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class OfflineAuth:
+    """
+    OfflineAuth
+    signs the test tokens and serves the matching public keys in place of
+    Auth0, the key fetches are counted in the measured Cost
+    """
+    kid = 'offline-test-key'
+
+    def __init__(self):
+        key = RSA.generate(2048)
+        self.private_key = key.exportKey().decode()
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'n': _b64(key.n),
+            'e': _b64(key.e)
+        }]}
+        self.fetches = 0
+
+    def token(self, permissions, **claims):
+        """A token of the API with the given permissions"""
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'sub': 'offline|test',
+            'aud': auth.API_AUDIENCE,
+            'iat': now,
+            'exp': now + 3600,
+            'permissions': list(permissions),
+            **claims
+        }
+        return jwt.encode(claims, self.private_key, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def headers(self, permissions, **claims):
+        return {'Authorization': f'Bearer {self.token(permissions, **claims)}'}
+
+    def urlopen(self, url, *args, **kwargs):
+        self.fetches += 1
+        for cost in _current:
+            cost.http_calls.append(url)
+        return mock.Mock(read=mock.Mock(
+            return_value=json.dumps(self.jwks).encode()))
+
+    @contextmanager
+    def installed(self):
+        """Serve the keys from this object, starting with a cold cache"""
+        auth.clear_jwks_cache()
+        with mock.patch.object(auth, 'urlopen', self.urlopen):
+            yield self
+        auth.clear_jwks_cache()
@@ -4,15 +4,32 @@ from sqlalchemy import exc
 import json
 from flask_cors import CORS
 
-from ..auth.auth import AuthError, requires_auth
+from .admission import setup_admission
+from .batch import batch_operations, batch_permissions, apply_batch
+from .cache import setup_drink_cache, MISSING
+from .compression import setup_compression
+from .idempotency import idempotent, setup_idempotency
+from ..auth.auth import AuthError, requires_auth, requires_auth_all
 from ..database.models import drinks_list_short, drinks_list_complete, Drink, \
-    setup_db
+    drink_rows, drink_projection, DRINK_FIELDS, setup_db
+from ..database.analytics import menu_analytics, \
+    register_analytics_commands
+from ..database.tenancy import setup_tenancy
+from ..database.transfer import register_commands
 
 
 def create_app():
     app = Flask(__name__)
     db = setup_db(app)
+    setup_tenancy(app)
     CORS(app)
+    setup_compression(app)
+    admission = setup_admission(app)
+    setup_idempotency(app)
+    app.config.setdefault('BATCH_MAX_OPERATIONS', 500)
+    drink_cache = setup_drink_cache(app)
+    register_commands(app)
+    register_analytics_commands(app)
 
     # '''
     # @TODO uncomment the following line to initialize the datbase
@@ -39,9 +56,26 @@ def create_app():
     #     where drinks is the list of drinks or appropriate status code
     #     indicating reason for failure
     # '''
+    def requested_fields():
+        """
+        Return the drink columns asked for with ?fields=id,title
+        in the model order, None when all of them are wanted
+        """
+        value = request.args.get('fields')
+        if value is None:
+            return None
+        fields = {field.strip() for field in value.split(',')}
+        if not fields or not fields <= set(DRINK_FIELDS):
+            abort(400)
+        return tuple(field for field in DRINK_FIELDS if field in fields)
+
     @app.route('/drinks')
     def get_drinks_short():
-        drinks = drinks_list_short(Drink.query.all())
+        fields = requested_fields()
+        if fields is not None:
+            drinks = drink_projection(fields, 'short')
+        else:
+            drinks = drinks_list_short(drink_rows())
         return jsonify({
             "success": True,
             "drinks": drinks
@@ -59,12 +93,48 @@ def create_app():
     @app.route('/drinks-detail')
     @requires_auth('get:drinks-detail')
     def get_drinks_complete(payload):
-        drinks = drinks_list_complete(Drink.query.all())
+        fields = requested_fields()
+        if fields is not None:
+            drinks = drink_projection(fields, 'long')
+        else:
+            drinks = drinks_list_complete(drink_rows())
         return jsonify({
             'success': True,
             'drinks': drinks
         })
 
+    def cached_drink(drink_id, form):
+        """Return the cached form of a drink, honoring If-None-Match"""
+        fields = requested_fields()
+        if fields is not None:
+            # sparse fieldsets are read from the database, not cached
+            drinks = drink_projection(fields, form, drink_id)
+            if not drinks:
+                abort(404)
+            return jsonify({
+                'success': True,
+                'drinks': drinks
+            })
+        entry = drink_cache.get(drink_id)
+        if entry is MISSING:
+            abort(404)
+        if form == 'short':
+            body, etag = entry.short, entry.short_etag
+        else:
+            body, etag = entry.long, entry.long_etag
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag, weak=True)
+        return response.make_conditional(request)
+
+    @app.route('/drinks/<int:drink_id>')
+    def get_drink_short(drink_id):
+        return cached_drink(drink_id, 'short')
+
+    @app.route('/drinks-detail/<int:drink_id>')
+    @requires_auth('get:drinks-detail')
+    def get_drink_complete(payload, drink_id):
+        return cached_drink(drink_id, 'long')
+
     # '''
     # @TODO implement endpoint
     #     POST /drinks
@@ -77,6 +147,7 @@ def create_app():
     # '''
     @app.route('/drinks', methods=['POST'])
     @requires_auth('post:drinks')
+    @idempotent
     def insert_drink(payload):
         data = request.get_json()
         fields = ['title', 'recipe']
@@ -121,6 +192,7 @@ def create_app():
     # '''
     @app.route('/drinks/<int:drink_id>', methods=['PATCH'])
     @requires_auth('patch:drinks')
+    @idempotent
     def update_drink(payload, drink_id):
         old_drink = Drink.query.get(drink_id)
         if old_drink is None:
@@ -172,6 +244,34 @@ def create_app():
         except Exception:
             abort(400)
 
+    @app.route('/drinks/batch', methods=['POST'])
+    @requires_auth_all(batch_permissions)
+    @idempotent
+    def batch_drinks(payload):
+        mode, operations = batch_operations()
+        results, committed = apply_batch(mode, operations)
+        return jsonify({
+            'success': committed,
+            'mode': mode,
+            'results': results
+        }), 200 if committed else 422
+
+    @app.route('/analytics')
+    @requires_auth('get:drinks-detail')
+    def get_analytics(payload):
+        return jsonify({
+            'success': True,
+            'analytics': menu_analytics()
+        })
+
+    @app.route('/admission')
+    @requires_auth('get:admission')
+    def admission_stats(payload):
+        return jsonify({
+            'success': True,
+            'admission': admission.stats()
+        })
+
     # Error Handling
     @app.errorhandler(422)
     def unprocessable(error):
@@ -242,4 +342,30 @@ def create_app():
             "message": "access forbidden"
         }), 403
 
+    @app.errorhandler(409)
+    def conflict(error):
+        """
+        Error handling for a request still in flight under the same
+        Idempotency-Key
+        """
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        """
+        Error handling for the requests shed by the admission control
+        """
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        })
+        response.headers['Retry-After'] = \
+            str(app.config['ADMISSION_RETRY_AFTER'])
+        return response, 503
+
     return app
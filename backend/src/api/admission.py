@@ -0,0 +1,162 @@
+import time
+from threading import Condition, Lock
+from flask import request, abort, g
+
+
+# Request methods which never write
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RouteLimiter:
+    """
+    RouteLimiter
+    lets at most `limit` requests run at once, up to `queue_size` others
+    may wait `timeout` seconds for a slot before being shed
+    """
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._condition = Condition()
+
+    def acquire(self):
+        """
+        Take a slot, waiting in the queue when none is free
+        :return: False if the request must be shed
+        """
+        with self._condition:
+            if self.active < self.limit and self.waiting == 0:
+                return self._admit()
+            if self.waiting >= self.queue_size:
+                return self._shed()
+            self.waiting += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return self._shed()
+                    self._condition.wait(remaining)
+                return self._admit()
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def _admit(self):
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def _shed(self):
+        self.shed += 1
+        return False
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'queue_size': self.queue_size,
+            'active': self.active,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'shed': self.shed
+        }
+
+
+class AdmissionController:
+    """
+    AdmissionController
+    one RouteLimiter per route class:
+        - public_read: GET endpoints without permission
+        - auth_read: GET endpoints protected by requires_auth
+        - write: every other method
+    """
+    def __init__(self, app):
+        self.app = app
+        self.limiters = None
+        self._lock = Lock()
+
+    def _get_limiters(self):
+        """
+        Return the limiters of every route class of ADMISSION_LIMITS, they
+        are created together from the config on first use
+        """
+        limiters = self.limiters
+        if limiters is None:
+            with self._lock:
+                limiters = self.limiters
+                if limiters is None:
+                    config = self.app.config
+                    limiters = {
+                        route_class: RouteLimiter(
+                            limit,
+                            config['ADMISSION_QUEUE_SIZE'],
+                            config['ADMISSION_QUEUE_TIMEOUT'])
+                        for route_class, limit
+                        in config['ADMISSION_LIMITS'].items()}
+                    self.limiters = limiters
+        return limiters
+
+    def limiter(self, route_class):
+        """Return the limiter of a route class"""
+        return self._get_limiters()[route_class]
+
+    def stats(self):
+        return {route_class: limiter.stats()
+                for route_class, limiter in self._get_limiters().items()}
+
+
+def route_class(view, method):
+    """Return the route class of a view function for a request method"""
+    if method not in READ_METHODS:
+        return 'write'
+    if getattr(view, 'permission', None) is not None:
+        return 'auth_read'
+    return 'public_read'
+
+
+def setup_admission(app):
+    """
+    setup_admission(app)
+    limits the number of concurrent requests per route class, the requests
+    exceeding the limit and the wait queue are answered with a 503 error
+    """
+    app.config.setdefault('ADMISSION_LIMITS', {
+        'public_read': 64,
+        'auth_read': 32,
+        'write': 8
+    })
+    app.config.setdefault('ADMISSION_QUEUE_SIZE', 32)
+    app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 0.5)
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+    app.config.setdefault('ADMISSION_EXEMPT_ENDPOINTS',
+                          {'admission_stats', 'static'})
+    controller = AdmissionController(app)
+    app.extensions['admission'] = controller
+
+    @app.before_request
+    def admit_request():
+        endpoint = request.endpoint
+        if (endpoint is None or request.method == 'OPTIONS'
+                or endpoint in app.config['ADMISSION_EXEMPT_ENDPOINTS']):
+            return
+        limiter = controller.limiter(
+            route_class(app.view_functions[endpoint], request.method))
+        if not limiter.acquire():
+            abort(503)
+        g.admission_limiter = limiter
+
+    @app.teardown_request
+    def release_request(exception):
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
+
+    return controller
@@ -0,0 +1,132 @@
+import json
+from flask import request, abort, current_app
+from sqlalchemy import exc
+
+from ..database.models import db, Drink, is_recipe
+
+
+# Permission needed by each batch operation
+OPERATION_PERMISSIONS = {
+    'update': 'patch:drinks',
+    'delete': 'delete:drinks'
+}
+
+BATCH_MODES = ('atomic', 'partial')
+
+
+def batch_operations():
+    """
+    Return the mode and the operations of the batch request body
+    abort with a 422 error if the body is malformed
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(422)
+    mode = data.get('mode', 'atomic')
+    operations = data.get('operations')
+    if (mode not in BATCH_MODES
+            or not isinstance(operations, list)
+            or not operations
+            or len(operations) > current_app.config['BATCH_MAX_OPERATIONS']
+            or not all(isinstance(operation, dict)
+                       and operation.get('op') in OPERATION_PERMISSIONS
+                       for operation in operations)):
+        abort(422)
+    return mode, operations
+
+
+def batch_permissions():
+    """The union of the permissions needed by the batch operations"""
+    mode, operations = batch_operations()
+    return {OPERATION_PERMISSIONS[operation['op']]
+            for operation in operations}
+
+
+def _failure(operation, error, message):
+    return {
+        'op': operation['op'],
+        'id': operation.get('id'),
+        'success': False,
+        'error': error,
+        'message': message
+    }
+
+
+class _Batch:
+    """The drinks targeted by a batch, as the operations are applied"""
+    def __init__(self, operations):
+        ids = {operation.get('id') for operation in operations
+               if type(operation.get('id')) == int}
+        titles = {operation['title'].lower() for operation in operations
+                  if isinstance(operation.get('title'), str)}
+        self.drinks = {drink.id: drink for drink
+                       in Drink.query.filter(Drink.id.in_(ids))}
+        # the drinks holding the titles, to keep them unique
+        self.titles = {drink.title.lower(): drink.id for drink
+                       in Drink.query.filter(
+                           db.func.lower(Drink.title).in_(titles))}
+        self.titles.update((drink.title.lower(), drink.id)
+                           for drink in self.drinks.values())
+
+    def apply(self, operation):
+        """Apply one operation, return its result"""
+        drink = self.drinks.get(operation.get('id'))
+        if drink is None:
+            return _failure(operation, 404, 'resource not found')
+        if operation['op'] == 'delete':
+            del self.drinks[drink.id]
+            self.titles.pop(drink.title.lower(), None)
+            db.session.delete(drink)
+            # the updates are flushed before the deletes, the title is only
+            # free for the next operations once the row is deleted
+            db.session.flush()
+            return {'op': 'delete', 'id': drink.id, 'success': True}
+
+        title, recipe = operation.get('title'), operation.get('recipe')
+        if ((title is None and recipe is None)
+                or (title is not None and not isinstance(title, str))
+                # a recipe the menu can't serialize would break GET /drinks
+                or (recipe is not None and not is_recipe(recipe))):
+            return _failure(operation, 422, 'unprocessable')
+        if title is not None:
+            if self.titles.get(title.lower(), drink.id) != drink.id:
+                return _failure(operation, 422, 'duplicate title')
+            self.titles.pop(drink.title.lower(), None)
+            self.titles[title.lower()] = drink.id
+            drink.title = title
+        if recipe is not None:
+            # The data recipe must be a list of dictionaries
+            if type(recipe) == dict:
+                recipe = [recipe]
+            drink.recipe = json.dumps(recipe)
+        return {'op': 'update', 'id': drink.id, 'success': True,
+                'drink': drink.long()}
+
+
+def apply_batch(mode, operations):
+    """
+    apply_batch(mode, operations)
+        applies the operations in one transaction
+        - atomic mode: nothing is written if one operation fails
+        - partial mode: the failed operations are skipped
+        nothing is written either if the transaction can't be committed
+    :return: the results of the operations and whether they were committed
+    """
+    results = []
+    try:
+        batch = _Batch(operations)
+        for operation in operations:
+            results.append(batch.apply(operation))
+        if mode == 'partial' or all(result['success'] for result in results):
+            db.session.commit()
+            return results, True
+        message = 'not applied'
+    except exc.SQLAlchemyError:
+        current_app.logger.exception('batch not committed')
+        message = 'not committed'
+        results += [_failure(operation, 409, message)
+                    for operation in operations[len(results):]]
+    db.session.rollback()
+    return [result if not result['success'] else
+            _failure(result, 409, message)
+            for result in results], False
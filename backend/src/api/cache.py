@@ -0,0 +1,97 @@
+import hashlib
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from flask import jsonify
+
+from ..database.models import on_drink_write, drink_row
+from ..database.tenancy import current_tenant
+
+
+# The serialized responses of one drink, with their ETag
+CachedDrink = namedtuple('CachedDrink', ['short', 'short_etag',
+                                         'long', 'long_etag'])
+
+# Cached value of the ids without a drink
+MISSING = object()
+
+
+def _serialize(drink):
+    body = jsonify({
+        'success': True,
+        'drinks': [drink]
+    }).get_data()
+    return body, hashlib.sha1(body).hexdigest()
+
+
+class DrinkCache:
+    """
+    DrinkCache
+    a bounded LRU of the serialized drinks per shop and id, the ids without
+    a drink are cached too, an entry is dropped as soon as its drink is
+    written by this process and after ttl seconds at most, for the writes of
+    the other processes
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (entry, load time)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        # bumped on each write, a load that saw a write is not cached
+        self._generation = 0
+
+    def get(self, drink_id):
+        """Return the CachedDrink of the id, MISSING if there's no drink"""
+        key = (current_tenant(), drink_id)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._entries.move_to_end(key)
+                return cached[0]
+            generation = self._generation
+        entry = self._load(drink_id)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (entry, now)
+                self._entries.move_to_end(key)
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _load(drink_id):
+        row = drink_row(drink_id)
+        if row is None:
+            return MISSING
+        return CachedDrink(*_serialize(row.short()), *_serialize(row.long()))
+
+    def invalidate(self, drink_ids):
+        tenant = current_tenant()
+        with self._lock:
+            self._generation += 1
+            for drink_id in drink_ids:
+                self._entries.pop((tenant, drink_id), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, drink_id):
+        return (current_tenant(), drink_id) in self._entries
+
+
+def setup_drink_cache(app):
+    """
+    setup_drink_cache(app)
+    the cache of the single drink endpoints, DRINK_CACHE_SIZE ids at most
+    kept DRINK_CACHE_TTL seconds at most, the delay before the writes of
+    the other worker processes are seen
+    """
+    app.config.setdefault('DRINK_CACHE_SIZE', 1024)
+    app.config.setdefault('DRINK_CACHE_TTL', 5)
+    cache = DrinkCache(app.config['DRINK_CACHE_SIZE'],
+                       app.config['DRINK_CACHE_TTL'])
+    on_drink_write(app, cache.invalidate)
+    app.extensions['drink_cache'] = cache
+    return cache
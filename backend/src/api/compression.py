@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from flask import request
+
+from ..database.models import on_drink_write
+from ..database.tenancy import current_tenant
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+def _gzip(body, level):
+    return gzip.compress(body, compresslevel=level)
+
+
+def _brotli(body, level):
+    return brotli.compress(body, quality=min(level, 11))
+
+
+# Supported encodings, in order of preference
+ENCODERS = {'gzip': _gzip}
+if brotli is not None:
+    ENCODERS = {'br': _brotli, 'gzip': _gzip}
+
+
+class CompressedBodyCache:
+    """
+    CompressedBodyCache
+    an LRU of the compressed bodies of the drinks list responses per shop,
+    endpoint, fields and encoding, bounded by the size of the compressed
+    bodies, the shop entries are dropped each time one of its drinks is
+    written
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # key -> (digest of the body, compressed body)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, key, body):
+        """Return the cached compressed body if it matches the given body"""
+        digest = _digest(body)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != digest:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, body, compressed):
+        if len(compressed) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (_digest(body), compressed)
+            self._bytes += len(compressed)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def invalidate(self, drink_ids):
+        tenant = current_tenant()
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == tenant]:
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """Total size of the cached compressed bodies, in bytes"""
+        return self._bytes
+
+
+def _digest(body):
+    return hashlib.sha256(body).digest()
+
+
+def _cache_key(encoding):
+    """
+    The key of the response body, the query string is reduced to the
+    requested fields so other parameters don't add entries
+    """
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = ','.join(sorted({field.strip()
+                                  for field in fields.split(',')}))
+    return current_tenant(), request.endpoint, fields, encoding
+
+
+def setup_compression(app):
+    """
+    setup_compression(app)
+    compresses the responses according to the request Accept-Encoding header
+    the responses of COMPRESSION_CACHED_ENDPOINTS are compressed once and
+    reused until a drink is written, COMPRESSION_CACHE_MAX_BYTES compressed
+    bytes at most
+    """
+    app.config.setdefault('COMPRESSION_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESSION_LEVEL', 6)
+    app.config.setdefault('COMPRESSION_CACHED_ENDPOINTS',
+                          {'get_drinks_short', 'get_drinks_complete'})
+    app.config.setdefault('COMPRESSION_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+    cache = CompressedBodyCache(app.config['COMPRESSION_CACHE_MAX_BYTES'])
+    on_drink_write(app, cache.invalidate)
+    app.extensions['compression_cache'] = cache
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        body = response.get_data()
+        if len(body) < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+        encoding = request.accept_encodings.best_match(list(ENCODERS))
+        if encoding is None:
+            return response
+
+        cached = (request.endpoint in
+                  app.config['COMPRESSION_CACHED_ENDPOINTS'])
+        key = _cache_key(encoding)
+        compressed = cache.get(key, body) if cached else None
+        if compressed is None:
+            compressed = ENCODERS[encoding](
+                body, app.config['COMPRESSION_LEVEL'])
+            if cached:
+                cache.set(key, body, compressed)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return cache
@@ -0,0 +1,205 @@
+import hashlib
+import time
+from functools import wraps
+from threading import Event
+from flask import request, abort, current_app
+from sqlalchemy import exc, or_, and_
+from werkzeug.exceptions import HTTPException
+
+from ..database.models import db, IdempotencyKey
+from ..database.tenancy import current_tenant
+
+
+def _sha256(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """
+    IdempotencyStore
+    runs a request once per Idempotency-Key, the first response is stored
+    in the database and replayed to the retries for IDEMPOTENCY_TTL seconds
+    """
+    def __init__(self, app):
+        self.app = app
+        # keys in flight in this process, retries wait on their event
+        self._in_flight = {}
+        # shop -> time of the last prune of its keys
+        self._pruned = {}
+
+    def run(self, key, fingerprint, view):
+        """Return the stored response of the key or the one of the view"""
+        config = self.app.config
+        deadline = time.monotonic() + config['IDEMPOTENCY_WAIT_TIMEOUT']
+        record = self._claim(key, fingerprint)
+        while record is not None:
+            if record.fingerprint != fingerprint:
+                abort(422)
+            if record.status is not None:
+                return self._replay(record)
+            # a concurrent duplicate is in flight, wait for its response
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                abort(409)
+            event = self._in_flight.get(key)
+            timeout = min(remaining, config['IDEMPOTENCY_POLL_INTERVAL'])
+            if event is not None:
+                event.wait(timeout)
+            else:
+                time.sleep(timeout)
+            record = self._claim(key, fingerprint)
+
+        try:
+            response = current_app.make_response(view())
+        except HTTPException as error:
+            db.session.rollback()
+            if error.code >= 500:
+                self._release(key)
+            else:
+                self._complete(key, error.code, None)
+            raise
+        except Exception:
+            db.session.rollback()
+            self._release(key)
+            raise
+        if response.status_code >= 500:
+            self._release(key)
+        else:
+            self._complete(key, response.status_code,
+                           response.get_data(as_text=True))
+        return response
+
+    def _claim(self, key, fingerprint):
+        """
+        Insert the in flight record of the key
+        :return: None if claimed, else the record already stored
+        """
+        config = self.app.config
+        now = time.time()
+        self._prune(now)
+        while True:
+            # the expired record of the key, or its abandoned claim
+            (IdempotencyKey.query
+             .filter(IdempotencyKey.key == key,
+                     or_(IdempotencyKey.created_at <
+                         now - config['IDEMPOTENCY_TTL'],
+                         and_(IdempotencyKey.status.is_(None),
+                              IdempotencyKey.created_at <
+                              now - config['IDEMPOTENCY_LOCK_TIMEOUT'])))
+             .delete(synchronize_session=False))
+            # a Core insert, the session may already hold the stored record
+            try:
+                db.session.execute(IdempotencyKey.__table__.insert().values(
+                    key=key, fingerprint=fingerprint, created_at=now))
+                db.session.commit()
+                self._in_flight[key] = Event()
+                return None
+            except exc.IntegrityError:
+                db.session.rollback()
+            record = IdempotencyKey.query.get(key)
+            if record is not None:
+                return record
+
+    def _prune(self, now):
+        """
+        Delete the expired keys and the oldest ones over the limit, once
+        every IDEMPOTENCY_PRUNE_INTERVAL seconds per shop so the writes
+        don't pay for the size of the table
+        """
+        config = self.app.config
+        tenant = current_tenant()
+        if now - self._pruned.get(tenant, 0) < \
+                config['IDEMPOTENCY_PRUNE_INTERVAL']:
+            return
+        self._pruned[tenant] = now
+        (IdempotencyKey.query
+         .filter(IdempotencyKey.created_at < now - config['IDEMPOTENCY_TTL'])
+         .delete(synchronize_session=False))
+        # the creation time of the oldest stored response to keep,
+        # found through the created_at index instead of counting the keys
+        oldest_kept = (db.session.query(IdempotencyKey.created_at)
+                       .filter(IdempotencyKey.status.isnot(None))
+                       .order_by(IdempotencyKey.created_at.desc())
+                       .offset(max(config['IDEMPOTENCY_MAX_KEYS'] - 1, 0))
+                       .limit(1)
+                       .scalar())
+        if oldest_kept is not None:
+            (IdempotencyKey.query
+             .filter(IdempotencyKey.status.isnot(None),
+                     IdempotencyKey.created_at <= oldest_kept)
+             .delete(synchronize_session=False))
+        db.session.commit()
+
+    def _complete(self, key, status, body):
+        record = IdempotencyKey.query.get(key)
+        if record is not None:
+            record.status = status
+            record.body = body
+            db.session.commit()
+        self._wake(key)
+
+    def _release(self, key):
+        """Forget the key of a failed request so it can be retried"""
+        IdempotencyKey.query.filter(IdempotencyKey.key == key) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        self._wake(key)
+
+    def _wake(self, key):
+        event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    @staticmethod
+    def _replay(record):
+        if record.body is None:
+            abort(record.status)
+        response = current_app.response_class(
+            record.body, record.status, mimetype='application/json')
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+
+def idempotent(f):
+    """
+    @idempotent decorator
+    to be placed under @requires_auth, a request sent again with the same
+    Idempotency-Key header gets the first response without running f again
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > 255:
+            abort(400)
+        store = current_app.extensions['idempotency']
+        return store.run(
+            _sha256(current_tenant() or '', payload.get('sub', ''),
+                    request.method, request.path, key),
+            _sha256(request.get_data()),
+            lambda: f(payload, *args, **kwargs))
+    return wrapper
+
+
+def setup_idempotency(app):
+    """
+    setup_idempotency(app)
+    stores the responses of the @idempotent endpoints
+    """
+    app.config.setdefault('IDEMPOTENCY_TTL', 24 * 60 * 60)
+    app.config.setdefault('IDEMPOTENCY_MAX_KEYS', 10000)
+    # the expired keys and the ones over the limit are deleted this often
+    app.config.setdefault('IDEMPOTENCY_PRUNE_INTERVAL', 60)
+    # how long a retry waits for the in flight duplicate
+    app.config.setdefault('IDEMPOTENCY_WAIT_TIMEOUT', 10)
+    app.config.setdefault('IDEMPOTENCY_POLL_INTERVAL', 0.05)
+    # an in flight key older than this is considered abandoned
+    app.config.setdefault('IDEMPOTENCY_LOCK_TIMEOUT', 60)
+    store = IdempotencyStore(app)
+    app.extensions['idempotency'] = store
+    return store
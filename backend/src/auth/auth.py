@@ -1,13 +1,24 @@
 import json
+import time
+from threading import Lock
 from flask import request, abort
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from ..database.tenancy import bind_token_tenant
+
 
 AUTH0_DOMAIN = 'manianis.eu.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'udacity_coffee_shop_api'
+# How long the Auth0 public keys are reused before being fetched again
+JWKS_CACHE_SECONDS = 10 * 60
+# Unknown key ids can't make the keys be fetched more often than this
+JWKS_MIN_REFRESH_SECONDS = 30
+
+_jwks_cache = {'jwks': None, 'fetched_at': 0}
+_jwks_lock = Lock()
 
 
 # AuthError Exception
@@ -68,19 +79,53 @@ def check_permissions(permission, payload):
     return True
 
 
+def check_tenant(payload):
+    """
+    Route the request to the shop of the token, if it has one.
+    - Raise an AuthError if the token belongs to another shop than the
+      one of the request path.
+    :param payload: decoded jwt payload
+    """
+    if not bind_token_tenant(payload):
+        raise AuthError({
+            'code': 'unauthorized_tenant',
+            'description': 'The token do not belong to this shop.'
+        }, 403)
+
+
 # !!NOTE urlopen has a common certificate error described here:
 # https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
+def get_jwks(refresh=False):
+    """
+    Get the public keys from Auth0, they are fetched once then reused for
+    JWKS_CACHE_SECONDS.
+    :param refresh: fetch the keys even if they are cached (key rotation)
+    :return: the json web key set
+    """
+    with _jwks_lock:
+        age = time.monotonic() - _jwks_cache['fetched_at']
+        if (_jwks_cache['jwks'] is None or age > JWKS_CACHE_SECONDS
+                or (refresh and age > JWKS_MIN_REFRESH_SECONDS)):
+            _jwks_cache['jwks'] = json.loads(
+                urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+                .read()
+            )
+            _jwks_cache['fetched_at'] = time.monotonic()
+        return _jwks_cache['jwks']
+
+
+def clear_jwks_cache():
+    """Forget the cached public keys"""
+    with _jwks_lock:
+        _jwks_cache['jwks'] = None
+
+
 def verify_decode_jwt(token):
     """
     Verify and decode the JWT Token. Than returns the payload.
     :param token: a json web token (string)
     :return: The decoded payload if no errors
     """
-    # Get the public key from Auth0
-    jwks = json.loads(
-        urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-        .read()
-    )
     # Get the data in the header of the token (JWT=header.payload.signature)
     unv_head = jwt.get_unverified_header(token)
     # Get the RSA key from 'jkws' and compare it with the 'unv_head'
@@ -90,6 +135,10 @@ def verify_decode_jwt(token):
             'code': 'invalid_token_header',
             'description': 'Token header malformed.'
         }, 401)
+    # Get the public key from Auth0, a new key may have been published
+    jwks = get_jwks()
+    if all(key['kid'] != unv_head['kid'] for key in jwks['keys']):
+        jwks = get_jwks(refresh=True)
     for key in jwks['keys']:
         if key['kid'] == unv_head['kid']:
             rsa_key = {
@@ -150,9 +199,36 @@ def requires_auth(permission=''):
             try:
                 token = get_token_auth_header()
                 payload = verify_decode_jwt(token)
+                check_tenant(payload)
                 check_permissions(permission, payload)
                 return f(payload, *args, **kwargs)
             except AuthError as error:
                 abort(error.status_code)
+        # lets the admission control tell protected endpoints apart
+        wrapper.permission = permission
+        return wrapper
+    return requires_auth_decorator
+
+
+def requires_auth_all(get_permissions):
+    """
+    @requires_auth_all(get_permissions) decorator
+    like @requires_auth, for the endpoints whose permissions depend on the
+    request, the token is verified once then every permission returned by
+    get_permissions() is checked
+    """
+    def requires_auth_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            try:
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                check_tenant(payload)
+                for permission in sorted(get_permissions()):
+                    check_permissions(permission, payload)
+                return f(payload, *args, **kwargs)
+            except AuthError as error:
+                abort(error.status_code)
+        wrapper.permission = get_permissions
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,365 @@
+import json
+from numbers import Number
+import click
+from sqlalchemy import Column, String, Integer, Float, event, inspect, \
+    select, bindparam
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .models import db, Drink, drink_rows
+from .tenancy import shop_option
+
+
+class ColorStat(db.Model):
+    """
+    ColorStat
+    the drinks using a color, and the parts of that color
+    """
+    color = Column(String(80), primary_key=True)
+    drinks = Column(Integer, nullable=False)
+    parts = Column(Float, nullable=False)
+
+
+class IngredientStat(db.Model):
+    """
+    IngredientStat
+    the drinks using an ingredient, and the parts of that ingredient
+    """
+    name = Column(String(180), primary_key=True)
+    drinks = Column(Integer, nullable=False)
+    parts = Column(Float, nullable=False)
+
+
+class MenuStat(db.Model):
+    """
+    MenuStat
+    the single row of the menu totals
+    """
+    id = Column(Integer, primary_key=True)
+    drinks = Column(Integer, nullable=False)
+    # number of ingredients over all the recipes
+    ingredients = Column(Integer, nullable=False)
+    parts = Column(Float, nullable=False)
+
+
+MENU_STAT_ID = 1
+
+
+class MenuStats:
+    """
+    MenuStats
+    aggregates of a set of recipes, recipes can be added or removed
+    (sign=-1) so the difference between two versions of a drink can be
+    applied to the stored aggregates
+    """
+    def __init__(self):
+        # key -> [drinks, parts]
+        self.colors = {}
+        self.ingredients = {}
+        self.drinks = 0
+        self.recipe_ingredients = 0
+        self.parts = 0
+
+    def add(self, recipe, sign=1):
+        """Add (or remove) the recipe blob of one drink"""
+        try:
+            recipe = json.loads(recipe)
+        except (TypeError, ValueError):
+            recipe = []
+        self.add_items(recipe, sign)
+
+    def add_items(self, recipe, sign=1):
+        """Add (or remove) the already decoded recipe of one drink"""
+        if not isinstance(recipe, list):
+            recipe = [recipe]
+        parts = {}
+        colors, ingredients = set(), set()
+        for item in recipe:
+            if not isinstance(item, dict):
+                continue
+            value = item.get('parts')
+            if isinstance(value, bool) or not isinstance(value, Number):
+                value = 0
+            color, name = item.get('color'), item.get('name')
+            if isinstance(color, str):
+                colors.add(color)
+                parts[('color', color)] = \
+                    parts.get(('color', color), 0) + value
+            if isinstance(name, str):
+                ingredients.add(name)
+                parts[('name', name)] = parts.get(('name', name), 0) + value
+            self.recipe_ingredients += sign
+            self.parts += sign * value
+        for color in colors:
+            self._count(self.colors, color, sign,
+                        parts[('color', color)])
+        for name in ingredients:
+            self._count(self.ingredients, name, sign, parts[('name', name)])
+        self.drinks += sign
+
+    @staticmethod
+    def _count(groups, key, sign, parts):
+        group = groups.setdefault(key, [0, 0])
+        group[0] += sign
+        group[1] += sign * parts
+
+    def __bool__(self):
+        return bool(self.drinks or self.recipe_ingredients or self.parts
+                    or any(drinks or parts for drinks, parts
+                           in (*self.colors.values(),
+                               *self.ingredients.values())))
+
+    def as_dict(self):
+        """
+        Comparable form of the aggregates, without the empty groups
+        (the parts are rounded, they are sums of floats)
+        """
+        return {
+            'drinks': self.drinks,
+            'ingredients': self.recipe_ingredients,
+            'parts': round(self.parts, 6),
+            'colors': {key: (drinks, round(parts, 6))
+                       for key, (drinks, parts) in self.colors.items()
+                       if drinks},
+            'names': {key: (drinks, round(parts, 6))
+                      for key, (drinks, parts) in self.ingredients.items()
+                      if drinks}
+        }
+
+
+def _insert_missing(connection, table, rows):
+    """
+    Insert the rows, skipping the ones inserted meanwhile by a concurrent
+    transaction
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(postgresql.insert(table).on_conflict_do_nothing(),
+                           rows)
+    elif dialect in ('sqlite', 'mysql'):
+        connection.execute(table.insert().prefix_with(
+            'OR IGNORE' if dialect == 'sqlite' else 'IGNORE'), rows)
+    else:
+        for row in rows:
+            savepoint = connection.begin_nested()
+            try:
+                connection.execute(table.insert(), row)
+                savepoint.commit()
+            except IntegrityError:
+                savepoint.rollback()
+
+
+def _apply_groups(connection, table, key_column, groups):
+    """
+    Add the groups differences with a constant number of statements,
+    whatever the number of groups
+    the missing groups are inserted empty first, so concurrent writes adding
+    the same new group both increment it, and emptied groups are kept
+    (rebuild_stats drops them) so an increment never misses its row
+    """
+    groups = {key: value for key, value in groups.items() if any(value)}
+    if not groups:
+        return
+    existing = {key for key, in connection.execute(
+        select([key_column]).where(key_column.in_(list(groups))))}
+    missing = [{key_column.name: key, 'drinks': 0, 'parts': 0}
+               for key in groups if key not in existing]
+    if missing:
+        _insert_missing(connection, table, missing)
+    connection.execute(
+        table.update()
+        .where(key_column == bindparam('_key'))
+        .values(drinks=table.c.drinks + bindparam('_drinks'),
+                parts=table.c.parts + bindparam('_parts')),
+        [{'_key': key, '_drinks': drinks, '_parts': parts}
+         for key, (drinks, parts) in groups.items()])
+
+
+def apply_stats(connection, stats):
+    """
+    Add the aggregates differences to the stored aggregates, before the
+    drinks writes they come from are executed
+    the aggregates of a database created before the menu analytics are
+    rebuilt from the drinks first
+    """
+    _apply_groups(connection, ColorStat.__table__,
+                  ColorStat.__table__.c.color, stats.colors)
+    _apply_groups(connection, IngredientStat.__table__,
+                  IngredientStat.__table__.c.name, stats.ingredients)
+    table = MenuStat.__table__
+    update = (table.update()
+              .where(table.c.id == MENU_STAT_ID)
+              .values(drinks=table.c.drinks + stats.drinks,
+                      ingredients=table.c.ingredients
+                      + stats.recipe_ingredients,
+                      parts=table.c.parts + stats.parts))
+    if connection.execute(update).rowcount == 0:
+        _store_stats(connection, _drinks_stats(connection))
+        apply_stats(connection, stats)
+
+
+def _drinks_stats(connection):
+    """Aggregates of the drinks stored, read through the connection"""
+    stats = MenuStats()
+    for recipe, in connection.execute(select([Drink.__table__.c.recipe])):
+        stats.add(recipe)
+    return stats
+
+
+def _clear_stats(connection):
+    for model in (ColorStat, IngredientStat, MenuStat):
+        connection.execute(model.__table__.delete())
+
+
+def _store_stats(connection, stats):
+    """Replace the stored aggregates"""
+    _clear_stats(connection)
+    _apply_groups(connection, ColorStat.__table__,
+                  ColorStat.__table__.c.color, stats.colors)
+    _apply_groups(connection, IngredientStat.__table__,
+                  IngredientStat.__table__.c.name, stats.ingredients)
+    _insert_missing(connection, MenuStat.__table__, [{
+        'id': MENU_STAT_ID,
+        'drinks': stats.drinks,
+        'ingredients': stats.recipe_ingredients,
+        'parts': stats.parts
+    }])
+
+
+@event.listens_for(Session, 'before_flush')
+def _maintain_stats(session, flush_context, instances):
+    """Apply the recipes differences of the flushed drinks"""
+    stats = MenuStats()
+    for drink in session.new:
+        if isinstance(drink, Drink):
+            stats.add(drink.recipe)
+    for drink in session.deleted:
+        if isinstance(drink, Drink):
+            # the stored recipe, even if it was changed before the delete
+            history = inspect(drink).attrs.recipe.history
+            stats.add(history.deleted[0] if history.deleted
+                      else drink.recipe, -1)
+    for drink in session.dirty:
+        if isinstance(drink, Drink) and drink not in session.deleted:
+            history = inspect(drink).attrs.recipe.history
+            if history.has_changes():
+                for recipe in history.deleted:
+                    stats.add(recipe, -1)
+                for recipe in history.added:
+                    stats.add(recipe)
+    if stats:
+        apply_stats(session.connection(mapper=inspect(Drink)), stats)
+
+
+def compute_stats():
+    """Aggregates of every drink, computed from scratch"""
+    stats = MenuStats()
+    for row in drink_rows():
+        stats.add(row.recipe)
+    return stats
+
+
+def stored_stats():
+    """Aggregates read from the aggregates tables"""
+    stats = MenuStats()
+    stats.colors = {stat.color: [stat.drinks, stat.parts]
+                    for stat in ColorStat.query}
+    stats.ingredients = {stat.name: [stat.drinks, stat.parts]
+                         for stat in IngredientStat.query}
+    menu = MenuStat.query.get(MENU_STAT_ID)
+    if menu is not None:
+        stats.drinks = menu.drinks
+        stats.recipe_ingredients = menu.ingredients
+        stats.parts = menu.parts
+    return stats
+
+
+def stats_differences(expected, actual):
+    """Return the lines describing the differences between two aggregates"""
+    expected, actual = expected.as_dict(), actual.as_dict()
+    lines = []
+    for field in ('drinks', 'ingredients', 'parts'):
+        if expected[field] != actual[field]:
+            lines.append(f'{field}: {actual[field]} instead of '
+                         f'{expected[field]}')
+    for group in ('colors', 'names'):
+        for key in sorted(expected[group].keys() | actual[group].keys()):
+            if expected[group].get(key) != actual[group].get(key):
+                lines.append(f'{group} {key!r}: {actual[group].get(key)} '
+                             f'instead of {expected[group].get(key)}')
+    return lines
+
+
+def rebuild_stats():
+    """
+    rebuild_stats()
+        recomputes the aggregates tables from the drinks
+    :return: the differences found with the previous aggregates
+    """
+    stored = stored_stats()
+    connection = db.session.connection(mapper=inspect(Drink))
+    # deleting first holds the write lock while the drinks are read
+    _clear_stats(connection)
+    stats = _drinks_stats(connection)
+    differences = stats_differences(stats, stored)
+    _store_stats(connection, stats)
+    db.session.commit()
+    return differences
+
+
+def menu_analytics():
+    """
+    The menu aggregates, as returned by the API, they are rebuilt first
+    for a database created before the menu analytics
+    """
+    menu = MenuStat.query.get(MENU_STAT_ID)
+    if menu is None:
+        rebuild_stats()
+        menu = MenuStat.query.get(MENU_STAT_ID)
+    drinks = menu.drinks
+    return {
+        'drinks': drinks,
+        'average_recipe_size': menu.ingredients / drinks if drinks else 0,
+        'average_parts': menu.parts / drinks if drinks else 0,
+        'colors': [{'color': stat.color, 'drinks': stat.drinks,
+                    'parts': stat.parts}
+                   for stat in ColorStat.query
+                   .filter(ColorStat.drinks > 0)
+                   .order_by(ColorStat.drinks.desc(), ColorStat.color)],
+        'ingredients': [{'name': stat.name, 'drinks': stat.drinks,
+                         'parts': stat.parts}
+                        for stat in IngredientStat.query
+                        .filter(IngredientStat.drinks > 0)
+                        .order_by(IngredientStat.drinks.desc(),
+                                  IngredientStat.name)]
+    }
+
+
+def register_analytics_commands(app):
+    """
+    register_analytics_commands(app)
+    adds the `flask rebuild-analytics` command to the application
+    """
+    @app.cli.command('rebuild-analytics')
+    @click.option('--check', is_flag=True,
+                  help='Only compare the aggregates with the drinks.')
+    @shop_option
+    def rebuild_analytics_command(check):
+        """Recompute the menu analytics aggregates from the drinks."""
+        if check:
+            differences = stats_differences(compute_stats(), stored_stats())
+            for line in differences:
+                click.echo(line)
+            if differences:
+                raise click.ClickException(
+                    f'{len(differences)} aggregates out of date')
+            click.echo('Aggregates up to date')
+            return
+        for line in rebuild_stats():
+            click.echo(f'fixed {line}')
+        differences = stats_differences(compute_stats(), stored_stats())
+        if differences:
+            raise click.ClickException('rebuilt aggregates differ: '
+                                       + '; '.join(differences))
+        click.echo('Aggregates rebuilt and verified')
@@ -1,14 +1,30 @@
 import os
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+from collections import namedtuple
+from sqlalchemy import Column, String, Integer, Float, Text, Index, event, \
+    exc, func, select
+from sqlalchemy.orm import Session, column_property
 import json
 
+from .tenancy import TenantSQLAlchemy
+
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
 database_path = "sqlite:///{}" \
     .format(os.path.join(project_dir, database_filename))
 
-db = SQLAlchemy()
+# the queries of a shop request are routed to the shop database
+db = TenantSQLAlchemy()
+
+
+def on_drink_write(app, listener):
+    """
+    on_drink_write(app, listener)
+        registers a callable invoked with the set of the drink ids
+        inserted, updated or deleted by the app once their transaction is
+        committed, the listeners live and die with their app
+    """
+    app.extensions.setdefault('drink_write_listeners', []).append(listener)
+    return listener
 
 
 def setup_db(app, database_path=database_path):
@@ -21,6 +37,12 @@ def setup_db(app, database_path=database_path):
     db.app = app
     db.init_app(app)
     db.create_all()
+    # create_all only indexes the new tables, older databases get the
+    # titles index here
+    try:
+        title_index.create(db.engine)
+    except exc.OperationalError:
+        pass
 
     return db
 
@@ -94,32 +116,23 @@ class Drink(db.Model):
     # the ingredients blob - this stores a lazy json blob
     # the required datatype is
     # [{'color': string, 'name':string, 'parts':number}]
-    recipe = Column(String(180), nullable=False)
+    # the previous recipe is kept on change to maintain the menu analytics
+    recipe = column_property(Column(String(180), nullable=False),
+                             active_history=True)
 
     def short(self):
         """
         short()
             short form representation of the Drink model
         """
-        # print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']}
-                        for r in json.loads(self.recipe)]
-        return {
-            'id': self.id,
-            'title': self.title,
-            'recipe': short_recipe
-        }
+        return short_form(self.id, self.title, self.recipe)
 
     def long(self):
         """
         long()
             long form representation of the Drink model
         """
-        return {
-            'id': self.id,
-            'title': self.title,
-            'recipe': json.loads(self.recipe)
-        }
+        return long_form(self.id, self.title, self.recipe)
 
     def insert(self):
         """
@@ -162,6 +175,130 @@ class Drink(db.Model):
         return json.dumps(self.short())
 
 
+# the titles are unique whatever their case, the lookups match them lowered
+title_index = Index('ix_drink_title_lower', func.lower(Drink.title))
+
+
+class IdempotencyKey(db.Model):
+    """
+    IdempotencyKey
+    the first response of a request sent with an Idempotency-Key header
+    """
+    # hash of the key scoped by the user, the method and the path
+    key = Column(String(64), primary_key=True)
+    # hash of the request body, a key can't be reused for another body
+    fingerprint = Column(String(64), nullable=False)
+    # unix time of the first request
+    created_at = Column(Float, nullable=False, index=True)
+    # the stored response, status is null while the request is in flight
+    status = Column(Integer)
+    body = Column(Text)
+
+
+def is_recipe(recipe):
+    """Whether the recipe is an ingredient or a list of ingredients"""
+    if type(recipe) == dict:
+        recipe = [recipe]
+    return (type(recipe) == list
+            and all(type(ingredient) == dict
+                    and 'color' in ingredient and 'parts' in ingredient
+                    for ingredient in recipe))
+
+
+def short_recipe(recipe):
+    """Short form of a recipe blob, without the ingredients names"""
+    return [{'color': r['color'], 'parts': r['parts']}
+            for r in json.loads(recipe)]
+
+
+def short_form(drink_id, title, recipe):
+    """Short form representation of the drink columns"""
+    return {
+        'id': drink_id,
+        'title': title,
+        'recipe': short_recipe(recipe)
+    }
+
+
+def long_form(drink_id, title, recipe):
+    """Long form representation of the drink columns"""
+    return {
+        'id': drink_id,
+        'title': title,
+        'recipe': json.loads(recipe)
+    }
+
+
+class DrinkRow(namedtuple('DrinkRow', ['id', 'title', 'recipe'])):
+    """
+    DrinkRow
+    a read-only drink, selected without the ORM instrumentation and
+    identity map, with the same short() and long() representations
+    """
+    __slots__ = ()
+
+    def short(self):
+        return short_form(self.id, self.title, self.recipe)
+
+    def long(self):
+        return long_form(self.id, self.title, self.recipe)
+
+
+def drink_rows():
+    """
+    drink_rows()
+        selects every drink as DrinkRow tuples through SQLAlchemy Core
+        EXAMPLE
+            drinks = drinks_list_short(drink_rows())
+    """
+    table = Drink.__table__
+    result = db.session.execute(
+        select([table.c.id, table.c.title, table.c.recipe]))
+    return map(DrinkRow._make, result)
+
+
+def drink_row(drink_id):
+    """
+    drink_row(drink_id)
+        selects one drink as a DrinkRow tuple, None if it doesn't exist
+    """
+    table = Drink.__table__
+    row = db.session.execute(
+        select([table.c.id, table.c.title, table.c.recipe])
+        .where(table.c.id == drink_id)).first()
+    return None if row is None else DrinkRow._make(row)
+
+
+# The drink columns which can be asked for with a sparse fieldset
+DRINK_FIELDS = tuple(Drink.__table__.columns.keys())
+
+
+def drink_projection(fields, form, drink_id=None):
+    """
+    drink_projection(fields, form)
+        selects only the fields columns of the drinks, a subset of
+        DRINK_FIELDS, and returns them as dicts with only these keys
+        the recipe is in the short or the long form
+        EXAMPLE
+            drinks = drink_projection(('id', 'title'), 'short')
+    """
+    table = Drink.__table__
+    query = select([table.c[field] for field in fields])
+    if drink_id is not None:
+        query = query.where(table.c.id == drink_id)
+    result = db.session.execute(query)
+    if 'recipe' not in fields:
+        return [dict(zip(fields, row)) for row in result]
+    parse = short_recipe if form == 'short' else json.loads
+    index = fields.index('recipe')
+    drinks = []
+    for row in result:
+        drink = dict(zip(fields, row))
+        drink['recipe'] = parse(row[index])
+        drinks.append(drink)
+    return drinks
+
+
 def drinks_list_short(drink_list):
     """Return the short form of Drink for a list"""
     return [drink.short() for drink in drink_list]
@@ -170,3 +307,30 @@ def drinks_list_short(drink_list):
 def drinks_list_complete(drink_list):
     """Return the long form of Drink for a list"""
     return [drink.long() for drink in drink_list]
+
+
+# Write notifications ---------------------------------------------------------
+def _track_drink_write(mapper, connection, target):
+    """Remember the written drink id until its transaction ends"""
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('drink_writes', set()).add(target.id)
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Drink, _event_name, _track_drink_write)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_drink_writes(session):
+    drink_ids = session.info.pop('drink_writes', None)
+    # the flask-sqlalchemy sessions know the app they were created for
+    app = getattr(session, 'app', None)
+    if drink_ids and app is not None:
+        for listener in app.extensions.get('drink_write_listeners', ()):
+            listener(drink_ids)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_drink_writes(session, previous_transaction):
+    session.info.pop('drink_writes', None)
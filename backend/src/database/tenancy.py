@@ -0,0 +1,296 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+import click
+from flask import g, request, abort, current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, exc, orm
+from sqlalchemy.engine.url import make_url
+
+
+# WSGI environ key of the shop given by the path prefix
+TENANT_ENVIRON_KEY = 'coffee_shop.tenant'
+
+# The shop names end up in database file names
+TENANT_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def current_tenant():
+    """
+    current_tenant()
+        the shop of the current request, None for the default database
+        caches must key their entries by it so shops never share them
+    """
+    if has_app_context():
+        return g.get('tenant')
+    return None
+
+
+def bind_token_tenant(payload):
+    """
+    bind_token_tenant(payload)
+        routes the request to the shop of the TENANT_CLAIM token claim
+        a request under a shop path needs a token of that shop, or a token
+        without shop holding the TENANT_ADMIN_PERMISSION permission
+    :return: False if the token can't be used for the shop of the request
+    """
+    config = current_app.config
+    if config.get('TENANT_DATABASE_URI') is None:
+        return True
+    path_tenant = g.get('tenant')
+    tenant = payload.get(config['TENANT_CLAIM'])
+    if tenant is None:
+        permissions = payload.get('permissions')
+        return (path_tenant is None
+                or (isinstance(permissions, list)
+                    and config['TENANT_ADMIN_PERMISSION'] in permissions))
+    if not isinstance(tenant, str) or not TENANT_NAME.match(tenant):
+        return False
+    if path_tenant not in (None, tenant):
+        return False
+    if shard_registry(current_app).engine(tenant) is None:
+        return False
+    g.tenant = tenant
+    return True
+
+
+def shop_option(f):
+    """
+    @shop_option decorator
+    to be placed under @app.cli.command, adds a --shop option running the
+    command against the database of that shop
+    """
+    @click.option('--shop', help='Shop whose database is used, the default '
+                                 'database when omitted.')
+    @wraps(f)
+    def wrapper(*args, shop=None, **kwargs):
+        if shop is not None:
+            if current_app.config.get('TENANT_DATABASE_URI') is None:
+                raise click.UsageError('--shop needs TENANT_DATABASE_URI')
+            if not TENANT_NAME.match(shop):
+                raise click.BadParameter('invalid shop name',
+                                         param_hint='--shop')
+            if shard_registry(current_app).engine(shop) is None:
+                raise click.BadParameter(f'unknown shop {shop!r}',
+                                         param_hint='--shop')
+            # the session may hold the rows of the default database
+            current_app.extensions['sqlalchemy'].db.session.remove()
+        g.tenant = shop
+        return f(*args, **kwargs)
+    return wrapper
+
+
+class ShardRegistry:
+    """
+    ShardRegistry
+    a bounded LRU of the shops engines (with their connection pools)
+    the engines are created on first use and disposed once evicted, the
+    shops databases are only created when asked for
+    """
+    def __init__(self, uri_template, metadata, max_engines, idle_timeout,
+                 engine_options=None):
+        self.uri_template = uri_template
+        self.metadata = metadata
+        self.max_engines = max_engines
+        self.idle_timeout = idle_timeout
+        self.engine_options = engine_options or {}
+        # tenant -> [engine, last use time], least recently used first
+        self._engines = OrderedDict()
+        # held for the LRU bookkeeping only, never while a database is created
+        self._lock = Lock()
+        # tenant -> lock held while its database is created
+        self._creating = {}
+
+    def engine(self, tenant, create=False):
+        """
+        Return the engine of a shop, None if the shop has no database
+        its database is created first when create is set
+        """
+        engine = self._get(tenant)
+        if engine is not None:
+            return engine
+        with self._lock:
+            creating = self._creating.setdefault(tenant, Lock())
+        # the other shops are served while this one's database is opened
+        with creating:
+            engine = self._get(tenant)
+            if engine is None:
+                engine = self._open(tenant, create)
+                if engine is not None:
+                    self._add(tenant, engine)
+        with self._lock:
+            if self._creating.get(tenant) is creating:
+                del self._creating[tenant]
+        return engine
+
+    def _open(self, tenant, create):
+        uri = self.uri_template.format(tenant=tenant)
+        url = make_url(uri)
+        # connecting to a missing sqlite database would create its file
+        if (not create and url.get_backend_name() == 'sqlite'
+                and not os.path.isfile(url.database or '')):
+            return None
+        engine = create_engine(uri, **self.engine_options)
+        if not create and not self._exists(engine):
+            engine.dispose()
+            return None
+        # the tables added since the database was created are created too
+        self.metadata.create_all(bind=engine)
+        return engine
+
+    def _exists(self, engine):
+        """Whether the database holds the tables of a shop"""
+        try:
+            return any(engine.has_table(table.name)
+                       for table in self.metadata.sorted_tables)
+        except exc.OperationalError:
+            return False
+
+    def _get(self, tenant):
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._evict_idle(now)
+            entry = self._engines.get(tenant)
+            if entry is not None:
+                entry[1] = now
+                self._engines.move_to_end(tenant)
+        self._dispose(evicted)
+        return entry[0] if entry is not None else None
+
+    def _add(self, tenant, engine):
+        evicted = []
+        with self._lock:
+            self._engines[tenant] = [engine, time.monotonic()]
+            while len(self._engines) > self.max_engines:
+                evicted.append(self._engines.popitem(last=False)[1][0])
+        self._dispose(evicted)
+
+    def _evict_idle(self, now):
+        evicted = []
+        while self._engines:
+            tenant, (engine, last_used) = next(iter(self._engines.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            del self._engines[tenant]
+            evicted.append(engine)
+        return evicted
+
+    @staticmethod
+    def _dispose(engines):
+        for engine in engines:
+            engine.dispose()
+
+    def dispose(self):
+        with self._lock:
+            engines = [engine for engine, _ in self._engines.values()]
+            self._engines.clear()
+        self._dispose(engines)
+
+    def __len__(self):
+        return len(self._engines)
+
+    def __contains__(self, tenant):
+        return tenant in self._engines
+
+
+class TenantSession(SignallingSession):
+    """
+    TenantSession
+    binds the queries of a shop request to the engine of that shop
+    """
+    def get_bind(self, mapper=None, clause=None):
+        tenant = current_tenant()
+        if tenant is not None:
+            engine = shard_registry(current_app).engine(tenant)
+            if engine is None:
+                abort(404)
+            return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class TenantSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=TenantSession, db=self, **options)
+
+
+def shard_registry(app):
+    """Return the ShardRegistry of the app, created from its config"""
+    registry = app.extensions.get('shards')
+    if registry is None:
+        config = app.config
+        registry = ShardRegistry(
+            config['TENANT_DATABASE_URI'],
+            app.extensions['sqlalchemy'].db.Model.metadata,
+            config['TENANT_MAX_ENGINES'],
+            config['TENANT_IDLE_TIMEOUT'],
+            config['TENANT_ENGINE_OPTIONS'])
+        registry = app.extensions.setdefault('shards', registry)
+    return registry
+
+
+class TenantPathMiddleware:
+    """
+    TenantPathMiddleware
+    strips the /shops/<tenant> prefix of the request path and keeps the
+    tenant in the WSGI environ, so every route is served per shop
+    """
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        prefix = self.app.config['TENANT_PATH_PREFIX']
+        path = environ.get('PATH_INFO', '')
+        if (self.app.config['TENANT_DATABASE_URI'] is not None
+                and path.startswith(prefix)):
+            tenant, _, rest = path[len(prefix):].partition('/')
+            environ[TENANT_ENVIRON_KEY] = tenant
+            environ['SCRIPT_NAME'] = \
+                environ.get('SCRIPT_NAME', '') + prefix + tenant
+            environ['PATH_INFO'] = '/' + rest
+        return self.wsgi_app(environ, start_response)
+
+
+def setup_tenancy(app):
+    """
+    setup_tenancy(app)
+    routes the requests of a shop, given by the /shops/<tenant> path prefix
+    or the TENANT_CLAIM token claim, to the shop database
+    TENANT_DATABASE_URI is a template like 'sqlite:///shops/{tenant}.db',
+    the tenancy is disabled while it's None, the shops are served once
+    their database is created by `flask create-shop`
+    """
+    app.config.setdefault('TENANT_DATABASE_URI', None)
+    app.config.setdefault('TENANT_PATH_PREFIX', '/shops/')
+    app.config.setdefault('TENANT_CLAIM', 'https://coffee-shop/shop')
+    app.config.setdefault('TENANT_ADMIN_PERMISSION', 'admin:shops')
+    app.config.setdefault('TENANT_MAX_ENGINES', 64)
+    app.config.setdefault('TENANT_IDLE_TIMEOUT', 10 * 60)
+    app.config.setdefault('TENANT_ENGINE_OPTIONS', {})
+    app.wsgi_app = TenantPathMiddleware(app, app.wsgi_app)
+
+    @app.before_request
+    def resolve_tenant():
+        tenant = request.environ.get(TENANT_ENVIRON_KEY)
+        if tenant is not None and (
+                not TENANT_NAME.match(tenant)
+                or shard_registry(app).engine(tenant) is None):
+            abort(404)
+        g.tenant = tenant
+
+    @app.cli.command('create-shop')
+    @click.argument('shop')
+    def create_shop_command(shop):
+        """Create the database of the shop SHOP, with an empty menu."""
+        if app.config['TENANT_DATABASE_URI'] is None:
+            raise click.UsageError('create-shop needs TENANT_DATABASE_URI')
+        if not TENANT_NAME.match(shop):
+            raise click.BadParameter('invalid shop name', param_hint='SHOP')
+        registry = shard_registry(app)
+        if registry.engine(shop) is not None:
+            raise click.ClickException(f'shop {shop!r} already exists')
+        registry.engine(shop, create=True)
+        click.echo(f'Created shop {shop!r}', err=True)
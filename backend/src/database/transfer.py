@@ -0,0 +1,173 @@
+import json
+import time
+import click
+
+from sqlalchemy import inspect, select, bindparam
+
+from .analytics import MenuStats, apply_stats
+from .models import db, Drink, is_recipe
+from .tenancy import shop_option
+
+
+def export_drinks(stream, batch_size=1000):
+    """
+    export_drinks(stream)
+        writes every drink as one json line (long form) to the stream
+        the drinks are fetched batch_size rows at a time
+    :return: the number of exported drinks
+    """
+    count = 0
+    for drink in Drink.query.order_by(Drink.id).yield_per(batch_size):
+        stream.write(json.dumps({'title': drink.title,
+                                 'recipe': json.loads(drink.recipe)}))
+        stream.write('\n')
+        count += 1
+    return count
+
+
+def _parse_line(line_number, line):
+    """Return the title, the recipe and the recipe blob of a json line"""
+    try:
+        data = json.loads(line)
+        title, recipe = data['title'], data['recipe']
+    except (ValueError, TypeError, KeyError):
+        raise click.ClickException(f'line {line_number}: invalid drink')
+    # a drink the menu can't serialize would break GET /drinks
+    if not isinstance(title, str) or not is_recipe(recipe):
+        raise click.ClickException(f'line {line_number}: invalid drink')
+    # The data recipe must be a list of dictionaries
+    if type(recipe) == dict:
+        recipe = [recipe]
+    return title, recipe, json.dumps(recipe)
+
+
+def _import_chunk(chunk, upsert):
+    """
+    Insert (or update) the drinks of one chunk, then commit them
+    the rows are written with one Core executemany per statement and the
+    menu analytics are updated once for the whole chunk
+    """
+    table = Drink.__table__
+    connection = db.session.connection(mapper=inspect(Drink))
+    # the titles are unique whatever their case, as for POST /drinks
+    titles = [title.lower() for _, title, _, _ in chunk]
+    existing = {title.lower(): [drink_id, recipe]
+                for drink_id, title, recipe in connection.execute(
+                    select([table.c.id, table.c.title, table.c.recipe])
+                    .where(db.func.lower(table.c.title).in_(titles)))}
+    stored = {title: recipe for title, (_, recipe) in existing.items()}
+    # lowered title -> row to insert, and the decoded recipes
+    inserts = {}
+    recipes = {}
+    updated = 0
+    for line_number, title, items, recipe in chunk:
+        key = title.lower()
+        if key not in existing and key not in inserts:
+            inserts[key] = {'title': title, 'recipe': recipe}
+        elif not upsert:
+            db.session.rollback()
+            raise click.ClickException(
+                f'line {line_number}: duplicate drink {title!r}')
+        elif key in inserts:
+            inserts[key]['recipe'] = recipe
+            updated += 1
+        else:
+            existing[key][1] = recipe
+            updated += 1
+        recipes[key] = items
+
+    stats = MenuStats()
+    for key in inserts:
+        stats.add_items(recipes[key])
+    updates = []
+    for key, (drink_id, recipe) in existing.items():
+        if recipe != stored[key]:
+            updates.append({'_id': drink_id, '_recipe': recipe})
+            stats.add(stored[key], -1)
+            stats.add_items(recipes[key])
+    # the aggregates are updated before the drinks are written, as on flush
+    if stats:
+        apply_stats(connection, stats)
+
+    written = set()
+    if inserts:
+        last_id = connection.execute(select([db.func.max(table.c.id)])) \
+            .scalar() or 0
+        connection.execute(table.insert(), list(inserts.values()))
+        new_last_id = connection.execute(
+            select([db.func.max(table.c.id)])).scalar()
+        written.update(range(last_id + 1, new_last_id + 1))
+    if updates:
+        connection.execute(table.update()
+                           .where(table.c.id == bindparam('_id'))
+                           .values(recipe=bindparam('_recipe')), updates)
+        written.update(update['_id'] for update in updates)
+    # the Core writes aren't seen by the ORM events, the app caches are
+    # notified of them like of the ORM writes
+    db.session.info.setdefault('drink_writes', set()).update(written)
+    db.session.commit()
+    return len(inserts), updated
+
+
+def import_drinks(stream, chunk_size=1000, upsert=False):
+    """
+    import_drinks(stream)
+        reads drinks from a json lines stream and commits them chunk_size
+        drinks at a time, an existing title is updated when upsert is set
+    :return: (inserted, updated) counts
+    """
+    inserted = updated = 0
+    chunk = []
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        chunk.append((line_number, *_parse_line(line_number, line)))
+        if len(chunk) >= chunk_size:
+            counts = _import_chunk(chunk, upsert)
+            inserted, updated = inserted + counts[0], updated + counts[1]
+            chunk = []
+    if chunk:
+        counts = _import_chunk(chunk, upsert)
+        inserted, updated = inserted + counts[0], updated + counts[1]
+    return inserted, updated
+
+
+def _report(action, count, started):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    # the report goes to stderr, stdout may be the exported data
+    click.echo(f'{action} {count} drinks in {elapsed:.2f}s '
+               f'({count / elapsed:.0f} rows/s)', err=True)
+
+
+def register_commands(app):
+    """
+    register_commands(app)
+    adds the `flask export` and `flask import` commands to the application
+    """
+    @app.cli.command('export')
+    @click.argument('output', type=click.File('w'), default='-')
+    @click.option('--batch-size', default=1000, show_default=True,
+                  help='Number of drinks fetched per query round trip.')
+    @shop_option
+    def export_command(output, batch_size):
+        """Export the drinks as json lines to OUTPUT (stdout by default)."""
+        started = time.perf_counter()
+        count = export_drinks(output, batch_size)
+        _report('Exported', count, started)
+
+    @app.cli.command('import')
+    @click.argument('source', type=click.File('r'), default='-')
+    @click.option('--chunk-size', default=1000, show_default=True,
+                  help='Number of drinks committed per transaction.')
+    @click.option('--upsert', is_flag=True,
+                  help='Update the recipe of the drinks already stored.')
+    @shop_option
+    def import_command(source, chunk_size, upsert):
+        """Import the json lines drinks of SOURCE (stdin by default)."""
+        if chunk_size < 1:
+            raise click.BadParameter('must be at least 1',
+                                     param_hint='--chunk-size')
+        started = time.perf_counter()
+        inserted, updated = import_drinks(source, chunk_size, upsert)
+        _report('Imported', inserted + updated, started)
+        click.echo(f'{inserted} inserted, {updated} updated', err=True)
@@ -1,9 +1,20 @@
+import gzip
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
 
 from src.api import create_app
-from src.database.models import setup_db, db_drop_and_create_all, Drink
+from src.database.analytics import compute_stats, stored_stats, \
+    stats_differences, apply_stats, MenuStats, ColorStat, IngredientStat, \
+    MenuStat
+from src.database.models import setup_db, db_drop_and_create_all, Drink, \
+    drink_rows, IdempotencyKey, db
 
 
 BARISTER_TOKEN = 'eyJhbGciOiJSUzI1NiIsInR5cCI6IkpXVCIsImtpZCI6IlNsV1ZCaFkw' \
@@ -36,6 +47,13 @@ MANAGER_TOKEN = 'eyJhbGciOiJSUzI1NiIsInR5cCI6IkpXVCIsImtpZCI6IlNsV1ZCaFkwV' \
                 'un0KgSJhCxMYbPOT98O7wV1a36Pp6smh6KJj4M6n3ivNItNE1iOcb4XyF' \
                 'h5LeBxj8rB11LnZ7pX_LdSvRNMQ'
 
+# Decoded payload of a manager token, for the tests run without Auth0
+MANAGER_PAYLOAD = {
+    'sub': 'manager',
+    'permissions': ['delete:drinks', 'get:drinks-detail', 'patch:drinks',
+                    'post:drinks']
+}
+
 
 class DrinkTestCase(unittest.TestCase):
     """This class represents the Drink resource test cases"""
@@ -342,6 +360,728 @@ class DrinkTestCase(unittest.TestCase):
                                    })
         self.assertEqual(res.status_code, 404)
 
+    def test_drink_rows_same_forms_as_orm(self):
+        """The read model rows serialize like the Drink instances"""
+        drinks = Drink.query.all()
+        rows = list(drink_rows())
+        self.assertEqual([row.short() for row in rows],
+                         [drink.short() for drink in drinks])
+        self.assertEqual([row.long() for row in rows],
+                         [drink.long() for drink in drinks])
+
+    def test_user_fetch_drink(self):
+        """Every user can get one drink in its short form"""
+        res = self.client().get('/drinks/1')
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.drink_data_is_in_short_form(data)
+        self.assertEqual(data['drinks'], [Drink.query.get(1).short()])
+
+    def test_user_fetch_drink_not_modified(self):
+        """A drink isn't sent again while its ETag matches"""
+        res = self.client().get('/drinks/1')
+        etag = res.headers['ETag']
+        res = self.client().get('/drinks/1',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        drink = Drink.query.get(1)
+        drink.title = 'Updated Drink'
+        drink.update()
+        res = self.client().get('/drinks/1',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['drinks'][0]['title'],
+                         'Updated Drink')
+
+    def test_user_fetch_inexistant_drink(self):
+        """Missing drinks are cached until a drink is written"""
+        cache = self.app.extensions['drink_cache']
+        drink_id = Drink.query.order_by(Drink.id.desc()).first().id + 1
+        res = self.client().get(f'/drinks/{drink_id}')
+        self.assertEqual(res.status_code, 404)
+        self.assertIn(drink_id, cache)
+        Drink(title='Water',
+              recipe=json.dumps([{'name': 'Water', 'color': 'blue',
+                                  'parts': 1}])).insert()
+        self.assertNotIn(drink_id, cache)
+        res = self.client().get(f'/drinks/{drink_id}')
+        self.assertEqual(res.status_code, 200)
+
+    def test_user_fetch_drink_cache_expires(self):
+        """Writes of another process are seen once the entry expired"""
+        cache = self.app.extensions['drink_cache']
+        self.client().get('/drinks/1')
+        # a Core update, as another worker's write, isn't notified
+        db.session.execute(Drink.__table__.update()
+                           .where(Drink.__table__.c.id == 1)
+                           .values(title='Other Worker Drink'))
+        db.session.commit()
+        res = self.client().get('/drinks/1')
+        self.assertEqual(res.get_json()['drinks'][0]['title'], 'Drink 1')
+        cache.ttl = 0
+        self.client().get('/drinks/1')
+        res = self.client().get('/drinks/1')
+        self.assertEqual(res.get_json()['drinks'][0]['title'],
+                         'Other Worker Drink')
+
+    def test_user_fetch_drink_details(self):
+        """Without role user doesn't have access to one drink details"""
+        res = self.client().get('/drinks-detail/1')
+        self.assertEqual(res.status_code, 401)
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_fetch_drink_details(self, verify_decode_jwt):
+        """Manager can view one drink details"""
+        res = self.client().get('/drinks-detail/1',
+                                headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.drink_data_is_in_long_form(data)
+        self.assertEqual(data['drinks'], [Drink.query.get(1).long()])
+
+    # Sparse fieldsets tests --------------------------------------------------
+    def test_user_fetch_drinks_fields(self):
+        """Only the asked fields are selected and sent"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            with mock.patch('src.database.models.json.loads') as loads:
+                res = self.client().get('/drinks?fields=title,id')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'], [
+            {'id': drink.id, 'title': drink.title}
+            for drink in Drink.query.all()
+        ])
+        loads.assert_not_called()
+        self.assertNotIn('recipe', ' '.join(statements))
+
+    def test_user_fetch_drinks_recipe_field(self):
+        """The recipe field keeps the short form on public endpoints"""
+        res = self.client().get('/drinks?fields=id,recipe')
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'], [
+            {'id': drink.id, 'recipe': drink.short()['recipe']}
+            for drink in Drink.query.all()
+        ])
+        res = self.client().get('/drinks/1?fields=title')
+        self.assertEqual(res.get_json()['drinks'],
+                         [{'title': Drink.query.get(1).title}])
+
+    def test_user_fetch_drinks_unknown_fields(self):
+        """Fields which are not drink columns are rejected"""
+        for fields in ('', 'id,price', 'id,,title'):
+            res = self.client().get(f'/drinks?fields={fields}')
+            self.assertEqual(res.status_code, 400)
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_fetch_drinks_details_fields(self, verify_decode_jwt):
+        """The recipe field is in the long form on detail endpoints"""
+        res = self.client().get('/drinks-detail?fields=recipe',
+                                headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'], [
+            {'recipe': drink.long()['recipe']}
+            for drink in Drink.query.all()
+        ])
+
+    # Batch tests -------------------------------------------------------------
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_batch_drinks(self, verify_decode_jwt):
+        """Manager can update and delete many drinks at once"""
+        res = self.client().post('/drinks/batch', json={'operations': [
+            {'op': 'update', 'id': 1, 'title': 'Seasonal Drink'},
+            {'op': 'delete', 'id': 2}
+        ]}, headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['results'][0]['drink']['title'],
+                         'Seasonal Drink')
+        self.assertEqual(data['results'][1],
+                         {'op': 'delete', 'id': 2, 'success': True})
+        self.assertEqual(Drink.query.get(1).title, 'Seasonal Drink')
+        self.assertIsNone(Drink.query.get(2))
+        verify_decode_jwt.assert_called_once()
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_batch_drinks_atomic_failure(self, verify_decode_jwt):
+        """Nothing is written when one operation of an atomic batch fails"""
+        drink_id = Drink.query.order_by(Drink.id.desc()).first().id + 1
+        operations = [
+            {'op': 'delete', 'id': 1},
+            {'op': 'update', 'id': 2, 'title': 'Drink 3'},
+            {'op': 'delete', 'id': drink_id}
+        ]
+        res = self.client().post('/drinks/batch', json={
+            'operations': operations
+        }, headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual([result['error'] for result in data['results']],
+                         [409, 422, 404])
+        self.assertIsNotNone(Drink.query.get(1))
+        self.assertEqual(Drink.query.get(2).title, 'Drink 2')
+
+        res = self.client().post('/drinks/batch', json={
+            'mode': 'partial',
+            'operations': operations
+        }, headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['success'] for result in data['results']],
+                         [True, False, False])
+        self.assertIsNone(Drink.query.get(1))
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_batch_reuses_deleted_title(self, verify_decode_jwt):
+        """A drink can take the title of a drink deleted by the batch"""
+        for mode in ('atomic', 'partial'):
+            with self.subTest(mode=mode):
+                db_drop_and_create_all()
+                res = self.client().post('/drinks/batch', json={
+                    'mode': mode,
+                    'operations': [{'op': 'delete', 'id': 1},
+                                   {'op': 'update', 'id': 2,
+                                    'title': 'Drink 1'}]
+                }, headers={'Authorization': 'Bearer token'})
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual([result['success'] for result
+                                  in res.get_json()['results']],
+                                 [True, True])
+                self.assertIsNone(Drink.query.get(1))
+                self.assertEqual(Drink.query.get(2).title, 'Drink 1')
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_batch_commit_failure(self, verify_decode_jwt):
+        """A failed commit is reported on each operation"""
+        error = exc.IntegrityError('UPDATE drink', {}, Exception('unique'))
+        with mock.patch.object(db.session, 'commit', side_effect=error):
+            res = self.client().post('/drinks/batch', json={
+                'mode': 'partial',
+                'operations': [{'op': 'update', 'id': 1, 'title': 'Tea'},
+                               {'op': 'delete', 'id': 2}]
+            }, headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual([(result['error'], result['message'])
+                          for result in data['results']],
+                         [(409, 'not committed')] * 2)
+        self.assertEqual(Drink.query.get(1).title, 'Drink 1')
+        self.assertIsNotNone(Drink.query.get(2))
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_batch_invalid_recipe(self, verify_decode_jwt):
+        """A recipe the menu can't serve fails its operation"""
+        res = self.client().post('/drinks/batch', json={
+            'mode': 'partial',
+            'operations': [{'op': 'update', 'id': 1, 'recipe': [1, 2]},
+                           {'op': 'update', 'id': 2,
+                            'recipe': {'name': 'Water'}}]
+        }, headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual([result['error'] for result in data['results']],
+                         [422, 422])
+        res = self.client().get('/drinks')
+        self.assertEqual(res.status_code, 200)
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value={'permissions': ['patch:drinks']})
+    def test_batch_drinks_needs_every_permission(self, verify_decode_jwt):
+        """The permissions of all the batch operations are required"""
+        res = self.client().post('/drinks/batch', json={'operations': [
+            {'op': 'update', 'id': 1, 'title': 'Seasonal Drink'},
+            {'op': 'delete', 'id': 2}
+        ]}, headers={'Authorization': 'Bearer token'})
+        self.assertEqual(res.status_code, 403)
+        res = self.client().post('/drinks/batch', json={'operations': [
+            {'op': 'rename', 'id': 1}
+        ]}, headers={'Authorization': 'Bearer token'})
+        self.assertEqual(res.status_code, 422)
+
+    # Analytics tests ---------------------------------------------------------
+    def assert_stats_up_to_date(self):
+        self.assertEqual(stats_differences(compute_stats(), stored_stats()),
+                         [])
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_analytics_follow_drinks_writes(self, verify_decode_jwt):
+        """Inserts, updates and deletes keep the aggregates up to date"""
+        headers = {'Authorization': 'Bearer token'}
+        self.assert_stats_up_to_date()
+        self.client().post('/drinks', json={'title': 'Latte', 'recipe': [
+            {'name': 'Milk', 'color': 'white', 'parts': 2},
+            {'name': 'Coffee', 'color': 'black', 'parts': 1}
+        ]}, headers=headers)
+        self.assert_stats_up_to_date()
+        self.client().patch('/drinks/3', json={'recipe': [
+            {'name': 'Milk', 'color': 'white', 'parts': 1.5}
+        ]}, headers=headers)
+        self.assert_stats_up_to_date()
+        self.client().delete('/drinks/1', headers=headers)
+        self.client().post('/drinks/batch', json={'operations': [
+            {'op': 'update', 'id': 2, 'recipe': {'name': 'Tea',
+                                                 'color': 'green',
+                                                 'parts': 3}},
+            {'op': 'delete', 'id': 4}
+        ]}, headers=headers)
+        self.assert_stats_up_to_date()
+
+        res = self.client().get('/analytics', headers=headers)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        analytics = data['analytics']
+        self.assertEqual(analytics['drinks'], 2)
+        self.assertEqual(analytics['average_recipe_size'], 1)
+        self.assertEqual(analytics['average_parts'], 2.25)
+        self.assertEqual(analytics['colors'], [
+            {'color': 'green', 'drinks': 1, 'parts': 3},
+            {'color': 'white', 'drinks': 1, 'parts': 1.5}
+        ])
+        self.assertEqual([stat['name'] for stat in analytics['ingredients']],
+                         ['Milk', 'Tea'])
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_analytics_of_older_database(self, verify_decode_jwt):
+        """Missing aggregates are rebuilt before being read or updated"""
+        headers = {'Authorization': 'Bearer token'}
+        count = Drink.query.count()
+        for model in (ColorStat, IngredientStat, MenuStat):
+            model.query.delete()
+        db.session.commit()
+        self.client().delete('/drinks/1', headers=headers)
+        self.assert_stats_up_to_date()
+        res = self.client().get('/analytics', headers=headers)
+        self.assertEqual(res.get_json()['analytics']['drinks'], count - 1)
+
+        MenuStat.query.delete()
+        db.session.commit()
+        res = self.client().get('/analytics', headers=headers)
+        self.assertEqual(res.get_json()['analytics']['drinks'], count - 1)
+        self.assert_stats_up_to_date()
+
+    def test_analytics_concurrent_new_groups(self):
+        """Two transactions adding the same new color both count"""
+        recipe = json.dumps([{'name': 'Violet Syrup', 'color': 'violet',
+                              'parts': 1}])
+        stats = MenuStats()
+        stats.add(recipe)
+        drinks = stored_stats().drinks
+        other = db.engine.connect()
+        raced = []
+
+        def race(conn, cursor, statement, *args):
+            # the other transaction inserts the color after this one found
+            # it missing
+            if not raced and statement.startswith('SELECT'):
+                raced.append(statement)
+                with other.begin():
+                    apply_stats(other, stats)
+
+        with db.engine.connect() as connection:
+            event.listen(connection, 'after_cursor_execute', race)
+            with connection.begin():
+                apply_stats(connection, stats)
+        other.close()
+        self.assertTrue(raced)
+        stored = stored_stats()
+        self.assertEqual(stored.colors['violet'], [2, 2])
+        self.assertEqual(stored.ingredients['Violet Syrup'], [2, 2])
+        self.assertEqual(stored.drinks, drinks + 2)
+
+    def test_user_fetch_analytics(self):
+        """Without role user doesn't have access to the analytics"""
+        res = self.client().get('/analytics')
+        self.assertEqual(res.status_code, 401)
+
+    # Compression tests -------------------------------------------------------
+    def test_user_fetch_drinks_gzip(self):
+        """Drinks list is gzip compressed when the client accepts it"""
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+        res = self.client().get('/drinks',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        data = json.loads(gzip.decompress(res.get_data()))
+        self.drink_data_is_in_short_form(data)
+
+    def test_user_fetch_drinks_under_compression_threshold(self):
+        """Small responses and clients without gzip are sent as is"""
+        self.app.config['COMPRESSION_MIN_SIZE'] = 1 << 20
+        res = self.client().get('/drinks',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+        res = self.client().get('/drinks',
+                                headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.drink_data_is_in_short_form(res.get_json())
+
+    def test_compressed_drinks_cache_invalidated_on_write(self):
+        """Compressed drinks list is cached until a drink is written"""
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+        cache = self.app.extensions['compression_cache']
+        self.client().get('/drinks', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(len(cache), 1)
+        Drink(title='Water',
+              recipe=json.dumps([{'name': 'Water', 'color': 'blue',
+                                  'parts': 1}])).insert()
+        self.assertEqual(len(cache), 0)
+        res = self.client().get('/drinks',
+                                headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(res.get_data()))
+        self.assertIn('Water', [drink['title'] for drink in data['drinks']])
+
+    def test_compressed_drinks_cache_bounded(self):
+        """Query strings don't add entries, the cache size is bounded"""
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+        cache = self.app.extensions['compression_cache']
+        for i in range(5):
+            self.client().get(f'/drinks?_={i}',
+                              headers={'Accept-Encoding': 'gzip'})
+        self.client().get('/drinks?fields=title,id',
+                          headers={'Accept-Encoding': 'gzip'})
+        self.client().get('/drinks?fields=id, title',
+                          headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(len(cache), 2)
+        # bounded by the compressed bytes, the least recently used go first
+        cache.max_bytes = cache.size
+        res = self.client().get('/drinks?fields=id',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        self.assertLess(len(cache), 3)
+        data = json.loads(gzip.decompress(res.get_data()))
+        self.assertEqual(set(data['drinks'][0]), {'id'})
+        res = self.client().get('/drinks?fields=id',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(json.loads(gzip.decompress(res.get_data())), data)
+
+    def test_write_listeners_per_app(self):
+        """The write listeners of an app are only notified of its writes"""
+        other = create_app()
+        self.assertEqual(
+            len(self.app.extensions['drink_write_listeners']), 2)
+        other_cache = other.extensions['compression_cache']
+        other_cache.invalidate = mock.Mock()
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+        self.client().get('/drinks', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(len(self.app.extensions['compression_cache']), 1)
+        db.session.remove()
+        with self.app.app_context():
+            Drink(title='Water',
+                  recipe=json.dumps([{'name': 'Water', 'color': 'blue',
+                                      'parts': 1}])).insert()
+        other_cache.invalidate.assert_not_called()
+        self.assertEqual(len(self.app.extensions['compression_cache']), 0)
+
+    # Admission control tests -------------------------------------------------
+    def test_request_shed_when_route_class_is_full(self):
+        """Requests over the limit and the queue size get a fast 503"""
+        self.app.config['ADMISSION_LIMITS']['public_read'] = 1
+        self.app.config['ADMISSION_QUEUE_SIZE'] = 0
+        limiter = self.app.extensions['admission'].limiter('public_read')
+        self.assertTrue(limiter.acquire())
+        res = self.client().get('/drinks')
+        data = res.get_json()
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+        self.assertEqual(res.headers['Retry-After'],
+                         str(self.app.config['ADMISSION_RETRY_AFTER']))
+        limiter.release()
+        res = self.client().get('/drinks')
+        self.assertEqual(res.status_code, 200)
+
+    def test_queued_request_shed_after_deadline(self):
+        """Queued requests are shed once their wait deadline is over"""
+        self.app.config['ADMISSION_LIMITS']['write'] = 1
+        self.app.config['ADMISSION_QUEUE_TIMEOUT'] = 0.01
+        limiter = self.app.extensions['admission'].limiter('write')
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(limiter.waiting, 0)
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value={'permissions': ['get:admission']})
+    def test_admission_stats(self, verify_decode_jwt):
+        """Queue depth and shed counts are exposed per route class"""
+        self.client().get('/drinks')
+        res = self.client().get('/admission',
+                                headers={'Authorization': 'Bearer token'})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['admission']),
+                         {'public_read', 'auth_read', 'write'})
+        stats = data['admission']['public_read']
+        self.assertEqual(stats['admitted'], 1)
+        self.assertEqual(stats['active'], 0)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['shed'], 0)
+        self.assertEqual(data['admission']['write']['admitted'], 0)
+
+    def test_admission_stats_unauthorized(self):
+        """The admission stats need the get:admission permission"""
+        res = self.client().get('/admission')
+        self.assertEqual(res.status_code, 401)
+
+    # Idempotency tests -------------------------------------------------------
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_retry_insert_drink(self, verify_decode_jwt):
+        """A retried insert gets the first response without a new drink"""
+        count = Drink.query.count()
+        headers = {'Authorization': 'Bearer token',
+                   'Idempotency-Key': 'insert-1'}
+        drink = {'title': 'New Drink',
+                 'recipe': {'name': 'part1', 'color': 'white', 'parts': 2}}
+        first = self.client().post('/drinks', json=drink, headers=headers)
+        retry = self.client().post('/drinks', json=drink, headers=headers)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Drink.query.count(), count + 1)
+
+        # the same key can't be used for another request body
+        drink['title'] = 'Other Drink'
+        res = self.client().post('/drinks', json=drink, headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_manager_retry_in_flight_update_drink(self, verify_decode_jwt):
+        """A retry waits for the in flight request under the same key"""
+        self.app.config['IDEMPOTENCY_WAIT_TIMEOUT'] = 0.1
+        headers = {'Authorization': 'Bearer token',
+                   'Idempotency-Key': 'update-1'}
+        with mock.patch.object(self.app.extensions['idempotency'],
+                               '_complete'):
+            res = self.client().patch('/drinks/1', json={'title': 'Tea'},
+                                      headers=headers)
+        self.assertEqual(res.status_code, 200)
+        # the first response was never stored, the request is in flight
+        self.assertIsNone(IdempotencyKey.query.one().status)
+        res = self.client().patch('/drinks/1', json={'title': 'Tea'},
+                                  headers=headers)
+        self.assertEqual(res.status_code, 409)
+
+        self.app.config['IDEMPOTENCY_LOCK_TIMEOUT'] = 0
+        time.sleep(0.01)
+        res = self.client().patch('/drinks/1', json={'title': 'Tea'},
+                                  headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(IdempotencyKey.query.one().status, 200)
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value=MANAGER_PAYLOAD)
+    def test_idempotency_keys_pruned_periodically(self, verify_decode_jwt):
+        """The keys over the limit are pruned once per prune interval"""
+        self.app.config['IDEMPOTENCY_MAX_KEYS'] = 2
+
+        def update(key):
+            res = self.client().patch('/drinks/1', json={'title': key},
+                                      headers={'Authorization': 'Bearer x',
+                                               'Idempotency-Key': key})
+            self.assertEqual(res.status_code, 200)
+
+        for key in ('a', 'b', 'c'):
+            update(key)
+        # pruned on the first request only, within the interval
+        self.assertEqual(IdempotencyKey.query.count(), 3)
+
+        self.app.config['IDEMPOTENCY_PRUNE_INTERVAL'] = 0
+        update('d')
+        self.assertEqual(IdempotencyKey.query.count(), 2)
+        # the oldest keys were deleted, the newest is still replayed
+        self.app.config['IDEMPOTENCY_PRUNE_INTERVAL'] = 60
+        res = self.client().patch('/drinks/1', json={'title': 'd'},
+                                  headers={'Authorization': 'Bearer x',
+                                           'Idempotency-Key': 'd'})
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+
+
+class TenantTestCase(unittest.TestCase):
+    """This class represents the shops sharding test cases"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        database_filename = "src/test_database.db"
+        project_dir = os.path.dirname(os.path.abspath(__file__))
+        database_path = "sqlite:///{}" \
+            .format(os.path.join(project_dir, database_filename))
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        self.app.config['TENANT_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(self.directory.name, 'shop_{tenant}.db'))
+        self.client = self.app.test_client
+        setup_db(self.app, database_path)
+        db_drop_and_create_all()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        db.session.remove()
+        self.app.extensions['shards'].dispose()
+        self.directory.cleanup()
+
+    def create_shops(self, *shops):
+        runner = self.app.test_cli_runner()
+        for shop in shops:
+            self.assertEqual(
+                runner.invoke(args=['create-shop', shop]).exit_code, 0)
+
+    def insert_drink(self, shop, title):
+        payload = {**MANAGER_PAYLOAD, 'https://coffee-shop/shop': shop}
+        with mock.patch('src.auth.auth.verify_decode_jwt',
+                        return_value=payload):
+            return self.client().post(f'/shops/{shop}/drinks', json={
+                'title': title,
+                'recipe': {'name': 'Water', 'color': 'blue', 'parts': 1}
+            }, headers={'Authorization': 'Bearer token'})
+
+    def test_shops_menus_are_isolated(self):
+        """Each shop reads and writes its own menu"""
+        self.create_shops('a', 'b')
+        self.assertEqual(self.insert_drink('a', 'Latte').status_code, 200)
+        self.assertEqual(self.insert_drink('b', 'Mocha').status_code, 200)
+        titles = {shop: [drink['title'] for drink in self.client()
+                         .get(f'/shops/{shop}/drinks').get_json()['drinks']]
+                  for shop in ('a', 'b')}
+        self.assertEqual(titles, {'a': ['Latte'], 'b': ['Mocha']})
+        self.assertNotIn('Latte', [drink.title
+                                   for drink in Drink.query.all()])
+
+    def test_shops_caches_are_isolated(self):
+        """A drink cached for one shop is never served to another"""
+        self.create_shops('a', 'b')
+        self.assertEqual(self.client().get('/shops/a/drinks/1').status_code,
+                         404)
+        self.insert_drink('b', 'Mocha')
+        res = self.client().get('/shops/b/drinks/1')
+        self.assertEqual(res.get_json()['drinks'][0]['title'], 'Mocha')
+        self.assertEqual(self.client().get('/shops/a/drinks/1').status_code,
+                         404)
+        res = self.client().get('/drinks/1')
+        self.assertEqual(res.get_json()['drinks'][0]['title'], 'Drink 1')
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value={**MANAGER_PAYLOAD,
+                              'https://coffee-shop/shop': 'b'})
+    def test_token_shop_claim(self, verify_decode_jwt):
+        """The token shop claim routes its requests to that shop"""
+        self.create_shops('a', 'b')
+        drink = {'title': 'Mocha',
+                 'recipe': {'name': 'Water', 'color': 'blue', 'parts': 1}}
+        headers = {'Authorization': 'Bearer token'}
+        res = self.client().post('/shops/a/drinks', json=drink,
+                                 headers=headers)
+        self.assertEqual(res.status_code, 403)
+        res = self.client().post('/drinks', json=drink, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/shops/b/drinks')
+        self.assertEqual(res.get_json()['drinks'][0]['title'], 'Mocha')
+
+    def test_shop_path_needs_shop_token(self):
+        """A token without shop needs the admin permission under a shop"""
+        self.create_shops('a')
+        drink = {'title': 'Mocha',
+                 'recipe': {'name': 'Water', 'color': 'blue', 'parts': 1}}
+        headers = {'Authorization': 'Bearer token'}
+        for permissions, status_code in (
+                (MANAGER_PAYLOAD['permissions'], 403),
+                (MANAGER_PAYLOAD['permissions'] + ['admin:shops'], 200)):
+            with self.subTest(permissions=permissions), mock.patch(
+                    'src.auth.auth.verify_decode_jwt',
+                    return_value={'permissions': permissions}):
+                res = self.client().post('/shops/a/drinks', json=drink,
+                                         headers=headers)
+                self.assertEqual(res.status_code, status_code)
+
+    @mock.patch('src.auth.auth.verify_decode_jwt',
+                return_value={**MANAGER_PAYLOAD,
+                              'https://coffee-shop/shop': 'c'})
+    def test_unknown_shops_are_not_created(self, verify_decode_jwt):
+        """Only the created shops are served, others get a 404 error"""
+        for shop in ('evil1', 'x' * 64):
+            with self.subTest(shop=shop):
+                res = self.client().get(f'/shops/{shop}/drinks')
+                self.assertEqual(res.status_code, 404)
+        res = self.client().get('/drinks-detail',
+                                headers={'Authorization': 'Bearer token'})
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+        runner = self.app.test_cli_runner()
+        self.create_shops('c')
+        res = self.client().get('/drinks-detail',
+                                headers={'Authorization': 'Bearer token'})
+        self.assertEqual(res.status_code, 200)
+        res = runner.invoke(args=['create-shop', 'c'])
+        self.assertIn('already exists', res.output)
+        res = runner.invoke(args=['create-shop', '../c'])
+        self.assertNotEqual(res.exit_code, 0)
+
+    def test_shops_engines_are_bounded(self):
+        """Least recently used and idle shop engines are evicted"""
+        self.create_shops('a', 'b', 'c')
+        shards = self.app.extensions['shards']
+        shards.dispose()
+        shards.max_engines = 2
+        for shop in ('a', 'b', 'c'):
+            self.client().get(f'/shops/{shop}/drinks')
+        self.assertEqual(len(shards), 2)
+        self.assertNotIn('a', shards)
+        shards.idle_timeout = 0
+        self.client().get('/shops/a/drinks')
+        self.assertEqual(len(shards), 1)
+        res = self.client().get('/shops/a.b/drinks')
+        self.assertEqual(res.status_code, 404)
+
+    def test_cold_shop_does_not_block_others(self):
+        """Other shops are served while a shop database is created"""
+        self.create_shops('a')
+        shards = self.app.extensions['shards']
+        creating, release = threading.Event(), threading.Event()
+        create_all = shards.metadata.create_all
+
+        def slow_create_all(bind):
+            creating.set()
+            release.wait(5)
+            create_all(bind=bind)
+
+        with mock.patch.object(shards.metadata, 'create_all',
+                               slow_create_all):
+            cold = threading.Thread(target=shards.engine, args=('b', True))
+            cold.start()
+            self.assertTrue(creating.wait(5))
+            res = self.client().get('/shops/a/drinks')
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn('b', shards)
+            release.set()
+            cold.join(5)
+        self.assertIn('b', shards)
+
 
 if __name__ == '__main__':
     unittest.main()
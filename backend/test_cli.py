@@ -0,0 +1,160 @@
+import json
+import os
+import tempfile
+import unittest
+
+from src.api import create_app
+from src.database.analytics import ColorStat
+from src.database.models import setup_db, db_drop_and_create_all, Drink, db
+
+
+class TransferTestCase(unittest.TestCase):
+    """This class represents the export/import commands test cases"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        database_filename = "src/test_database.db"
+        project_dir = os.path.dirname(os.path.abspath(__file__))
+        database_path = "sqlite:///{}" \
+            .format(os.path.join(project_dir, database_filename))
+
+        self.app = create_app()
+        self.runner = self.app.test_cli_runner()
+        setup_db(self.app, database_path)
+        db_drop_and_create_all()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        db.session.remove()
+
+    def test_export_drinks(self):
+        """Every drink is exported as one json line"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'drinks.ndjson')
+            res = self.runner.invoke(args=['export', path])
+            self.assertEqual(res.exit_code, 0)
+            with open(path) as export:
+                lines = [json.loads(line) for line in export]
+        self.assertEqual([line['title'] for line in lines],
+                         [drink.title for drink in Drink.query.all()])
+        self.assertIn('name', lines[0]['recipe'][0])
+
+    def test_import_drinks_in_chunks(self):
+        """Drinks are imported whatever the chunk size"""
+        lines = '\n'.join(json.dumps({
+            'title': f'Imported {i}',
+            'recipe': {'name': 'Water', 'color': 'blue', 'parts': i}
+        }) for i in range(5))
+        count = Drink.query.count()
+        res = self.runner.invoke(args=['import', '--chunk-size', '2'],
+                                 input=lines)
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual(Drink.query.count(), count + 5)
+        drink = Drink.query.filter(Drink.title == 'Imported 3').one()
+        self.assertEqual(drink.long()['recipe'][0]['parts'], 3)
+
+    def test_import_duplicate_drinks(self):
+        """Existing titles are rejected unless upsert is asked"""
+        line = json.dumps({'title': 'Drink 1', 'recipe': [
+            {'name': 'Milk', 'color': 'white', 'parts': 2}]})
+        res = self.runner.invoke(args=['import'], input=line)
+        self.assertNotEqual(res.exit_code, 0)
+        self.assertIn('duplicate', res.output)
+
+        count = Drink.query.count()
+        res = self.runner.invoke(args=['import', '--upsert'], input=line)
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual(Drink.query.count(), count)
+        drink = Drink.query.filter(Drink.title == 'Drink 1').one()
+        self.assertEqual(drink.long()['recipe'][0]['color'], 'white')
+
+    def test_import_invalid_line(self):
+        """An invalid line stops the import with its line number"""
+        res = self.runner.invoke(args=['import'], input='{"title": "x"}\n')
+        self.assertNotEqual(res.exit_code, 0)
+        self.assertIn('line 1', res.output)
+
+    def test_transfer_between_shops(self):
+        """A menu is exported from one shop and imported into another"""
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config['TENANT_DATABASE_URI'] = 'sqlite:///{}'.format(
+                os.path.join(directory, 'shop_{tenant}.db'))
+            path = os.path.join(directory, 'drinks.ndjson')
+            try:
+                res = self.runner.invoke(args=['export', path])
+                self.assertEqual(res.exit_code, 0)
+                res = self.runner.invoke(args=['import', '--shop', 'a',
+                                               path])
+                self.assertIn('unknown shop', res.output)
+                for shop in ('a', 'b'):
+                    res = self.runner.invoke(args=['create-shop', shop])
+                    self.assertEqual(res.exit_code, 0)
+                res = self.runner.invoke(args=['import', '--shop', 'a',
+                                               path])
+                self.assertEqual(res.exit_code, 0)
+                res = self.runner.invoke(args=['export', '--shop', 'a',
+                                               path + '.a'])
+                self.assertEqual(res.exit_code, 0)
+                with open(path + '.a') as export:
+                    titles = [json.loads(line)['title'] for line in export]
+                self.assertEqual(titles,
+                                 [drink.title for drink in Drink.query])
+                res = self.runner.invoke(args=['export', '--shop', 'b',
+                                               path + '.b'])
+                self.assertIn('Exported 0 drinks', res.output)
+                res = self.runner.invoke(args=['rebuild-analytics',
+                                               '--shop', 'a', '--check'])
+                self.assertEqual(res.exit_code, 0)
+                res = self.runner.invoke(args=['export', '--shop', '../a'])
+                self.assertNotEqual(res.exit_code, 0)
+            finally:
+                self.app.extensions['shards'].dispose()
+
+    def test_import_invalid_types(self):
+        """A title or a recipe the menu can't serve is rejected"""
+        count = Drink.query.count()
+        recipe = {'name': 'Water', 'color': 'blue', 'parts': 1}
+        for drink in ({'title': 5, 'recipe': recipe},
+                      {'title': 'Water', 'recipe': 'abc'},
+                      {'title': 'Water', 'recipe': [recipe, 'abc']},
+                      {'title': 'Water', 'recipe': {'name': 'Water'}}):
+            with self.subTest(drink=drink):
+                lines = json.dumps({'title': 'Tea', 'recipe': recipe}) \
+                    + '\n' + json.dumps(drink)
+                res = self.runner.invoke(args=['import'], input=lines)
+                self.assertNotEqual(res.exit_code, 0)
+                self.assertIn('line 2', res.output)
+                self.assertEqual(Drink.query.count(), count)
+
+    def test_import_titles_case_insensitive(self):
+        """Titles match the stored ones whatever their case"""
+        line = json.dumps({'title': 'drink 1', 'recipe': [
+            {'name': 'Milk', 'color': 'white', 'parts': 2}]})
+        res = self.runner.invoke(args=['import'], input=line)
+        self.assertNotEqual(res.exit_code, 0)
+        self.assertIn('duplicate', res.output)
+
+        count = Drink.query.count()
+        res = self.runner.invoke(args=['import', '--upsert'], input=line)
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual(Drink.query.count(), count)
+        drink = Drink.query.filter(Drink.title == 'Drink 1').one()
+        self.assertEqual(drink.long()['recipe'][0]['color'], 'white')
+
+    def test_rebuild_analytics(self):
+        """Out of date aggregates are found, rebuilt and verified"""
+        ColorStat.query.filter(ColorStat.color == 'red').delete()
+        db.session.commit()
+        res = self.runner.invoke(args=['rebuild-analytics', '--check'])
+        self.assertNotEqual(res.exit_code, 0)
+        self.assertIn("colors 'red'", res.output)
+
+        res = self.runner.invoke(args=['rebuild-analytics'])
+        self.assertEqual(res.exit_code, 0)
+        self.assertIn('verified', res.output)
+        res = self.runner.invoke(args=['rebuild-analytics', '--check'])
+        self.assertEqual(res.exit_code, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import json
+import os
+import unittest
+
+from perf_budget import Budget, BudgetExceeded, OfflineAuth, measure
+from src.api import create_app
+from src.database.analytics import rebuild_stats
+from src.database.models import setup_db, db, Drink
+
+
+# Number of drinks on the menu while the budgets are checked
+MENU_SIZE = 500
+
+MANAGER_PERMISSIONS = ['delete:drinks', 'get:drinks-detail', 'patch:drinks',
+                       'post:drinks']
+
+# method, path, body and budget of one request, with a warm key cache
+# the writes include the menu analytics maintenance, a constant number
+# of statements per aggregate table whatever the recipe size
+BUDGETS = [
+    ('GET', '/drinks', None,
+     Budget(max_queries=1, max_http_calls=0, max_alloc_kb=2048, max_ms=500)),
+    ('GET', '/drinks?fields=id,title', None,
+     Budget(max_queries=1, max_http_calls=0, max_alloc_kb=1024, max_ms=250)),
+    ('GET', '/drinks-detail', None,
+     Budget(max_queries=1, max_http_calls=0, max_alloc_kb=2048, max_ms=500)),
+    ('GET', '/drinks/1', None,
+     Budget(max_queries=1, max_http_calls=0, max_alloc_kb=256, max_ms=100)),
+    ('PATCH', '/drinks/1', {'title': 'Budget Drink'},
+     Budget(max_queries=3, max_http_calls=0, max_alloc_kb=256, max_ms=100)),
+    ('PATCH', '/drinks/3',
+     {'recipe': {'name': 'Tea', 'color': 'green', 'parts': 1}},
+     Budget(max_queries=12, max_http_calls=0, max_alloc_kb=256,
+            max_ms=100)),
+    ('DELETE', '/drinks/2', None,
+     Budget(max_queries=9, max_http_calls=0, max_alloc_kb=256, max_ms=100)),
+    ('GET', '/analytics', None,
+     Budget(max_queries=3, max_http_calls=0, max_alloc_kb=256, max_ms=100)),
+]
+
+
+class PerformanceBudgetTestCase(unittest.TestCase):
+    """This class checks the cost of the endpoints against their budget"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.auth = OfflineAuth()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        database_filename = "src/test_database.db"
+        project_dir = os.path.dirname(os.path.abspath(__file__))
+        database_path = "sqlite:///{}" \
+            .format(os.path.join(project_dir, database_filename))
+
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, database_path)
+        self.fill_menu()
+        self.headers = self.auth.headers(MANAGER_PERMISSIONS)
+
+    def fill_menu(self):
+        """Start from a menu of MENU_SIZE drinks"""
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        recipe = json.dumps([
+            {'name': 'Milk', 'color': 'lightgray', 'parts': 2},
+            {'name': 'Coffee', 'color': 'black', 'parts': 1}
+        ])
+        db.session.bulk_insert_mappings(Drink, [
+            {'title': f'Drink {i}', 'recipe': recipe}
+            for i in range(MENU_SIZE)
+        ])
+        db.session.commit()
+        rebuild_stats()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        db.session.remove()
+
+    def request(self, method, path, body=None):
+        return self.client().open(path, method=method, json=body,
+                                  headers=self.headers)
+
+    def measure_budgets(self, trace_memory):
+        """Return the cost of each BUDGETS request, on a fresh menu"""
+        self.fill_menu()
+        costs = []
+        with self.auth.installed():
+            # warms the key cache
+            res = self.request('GET', '/drinks-detail/3')
+            self.assertEqual(res.status_code, 200)
+            for method, path, body, _ in BUDGETS:
+                with measure(trace_memory) as cost:
+                    res = self.request(method, path, body)
+                self.assertEqual(res.status_code, 200)
+                costs.append(cost)
+        return costs
+
+    def test_endpoints_budgets(self):
+        """Every endpoint stays within its budget"""
+        # the latency is measured in a pass without the memory tracing
+        costs = self.measure_budgets(trace_memory=False)
+        traced = self.measure_budgets(trace_memory=True)
+        for (method, path, _, budget), cost, traced_cost in zip(
+                BUDGETS, costs, traced):
+            with self.subTest(f'{method} {path}'):
+                cost.alloc_kb = traced_cost.alloc_kb
+                cost.check(budget, f'{method} {path} with {MENU_SIZE} drinks')
+
+    def test_keys_fetched_once(self):
+        """Auth0 public keys are fetched once, not on every request"""
+        with self.auth.installed():
+            with measure() as cost:
+                for _ in range(3):
+                    res = self.client().get('/drinks-detail',
+                                            headers=self.headers)
+                    self.assertEqual(res.status_code, 200)
+            cost.check(Budget(max_http_calls=1), '3 x GET /drinks-detail')
+
+    def test_budget_exceeded_report(self):
+        """An exceeded budget fails with the cost and the statements"""
+        with measure() as cost:
+            list(Drink.query.limit(2))
+            Drink.query.count()
+        with self.assertRaises(BudgetExceeded) as context:
+            cost.check(Budget(max_queries=1), 'two queries')
+        report = str(context.exception)
+        self.assertRegex(report, r'sql statements +2 > 1')
+        self.assertIn('2. SELECT count(*)', report)
+
+
+if __name__ == '__main__':
+    unittest.main()